@@ -8,24 +8,14 @@ import sys
 from pathlib import Path
 from typing import cast
 from csv_update import get_data_dirs
-from upload_csv import last_upload_file, working_prefix
+from upload_lock import needs_recovery
 
 def fix_file(dir: Path) -> bool:
-    """Fix the lock file, if it needs it and can be fixed.
-    Return True if the lockfile was fixed, or False if it wasn't."""
-    fixed: bool = False
-    fname: Path = last_upload_file(dir)
-    if fname.exists():
-        contents: str = fname.read_text()
-        # print('"' + contents + '"')
-        if contents.startswith(working_prefix()):
-            numstr: str = contents.replace(working_prefix(), '')
-            # print('"' + numstr + '"')
-            if numstr.strip().isdigit():
-                fname.write_text(numstr)
-                fixed = True
-    # print('fix_file returning', fixed)
-    return fixed
+    """Return True if the last run died part way (or failed) and nothing
+    has run since, so the job should be rerun.  There is nothing left to
+    fix by hand: the upload lock went with the process that held it, and
+    the next run carries on from the heartbeat record (see upload_lock)."""
+    return needs_recovery(dir)
 
 # Note that the Nagios check runs every 3 minutes
 def rerun_job(dir: Path) -> int:
@@ -0,0 +1,169 @@
+# On-disk journal of a course backup run, so that an interrupted run can
+# pick up where it left off.  The journal is a JSON-lines file with one
+# line per state change; reading it back keeps the last state seen for
+# each course.  Appending whole lines means a crash can at worst lose the
+# line being written.
+#
+# The manifest of downloaded cartridges (filename, size, SHA-256) is kept
+# the same way, so later runs can trust a file without reading it again.
+
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Any, Optional
+import glob
+import hashlib
+import json
+import os
+import threading
+
+# Runs split across several workers (see course_backups --shard) each keep
+# their own journal and manifest, named e.g. 2526-FA.shard2of4.jsonl, so
+# that no two processes ever append to the same file.
+def shard_suffix(shard: Optional[tuple[int, int]]) -> str:
+    return '' if shard is None else '.shard{0}of{1}'.format(*shard)
+
+def journal_file(backups_dir: Path, term: str, shard: Optional[tuple[int, int]] = None) -> Path:
+    """Return the path of the journal for TERM (and SHARD) under BACKUPS_DIR."""
+    return backups_dir.joinpath('journals', term + shard_suffix(shard) + '.jsonl')
+
+def manifest_file(backups_dir: Path, term: str, shard: Optional[tuple[int, int]] = None) -> Path:
+    """Return the path of the manifest of TERM's cartridges (for SHARD) under BACKUPS_DIR."""
+    return backups_dir.joinpath('manifests', term + shard_suffix(shard) + '.jsonl')
+
+def shard_files(term_file: Path) -> list[Path]:
+    """Return the per-shard files that go with the whole-term file TERM_FILE."""
+    return sorted(term_file.parent.glob(glob.escape(term_file.stem) + '.shard*of*.jsonl'))
+
+def read_jsonl(path: Path, key: str) -> dict[Any, dict[str, Any]]:
+    """Read the JSON-lines file at PATH, merging the lines that share the
+    same value for KEY so the latest fields win.  A missing file is empty."""
+    entries: dict[Any, dict[str, Any]] = {}
+    if path.is_file():
+        with open(path) as f:
+            for line in f:
+                try:
+                    entry: dict[str, Any] = json.loads(line)
+                except json.JSONDecodeError:  # Torn last line from a crash
+                    continue
+                entries[entry[key]] = dict(entries.get(entry[key], {}), **entry)
+    return entries
+
+def append_jsonl(path: Path, entry: dict[str, Any]) -> None:
+    """Append ENTRY to the JSON-lines file at PATH, making sure it is on disk."""
+    with open(path, 'a') as f:
+        f.write(json.dumps(entry) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+def merge_jsonl(term_file: Path, key: str) -> dict[Any, dict[str, Any]]:
+    """Fold the per-shard files for TERM_FILE into it, so that it holds
+    one line per KEY with the latest state from any shard.  The shard
+    files are left alone.  Returns the merged entries."""
+    entries: dict[Any, dict[str, Any]] = read_jsonl(term_file, key)
+    for path in shard_files(term_file):
+        for value, entry in read_jsonl(path, key).items():
+            old = entries.get(value, {})
+            if entry.get('updated_at', '') >= old.get('updated_at', ''):
+                entries[value] = dict(old, **entry)
+    tmpfile = term_file.with_name(term_file.name + '.tmp')
+    with open(tmpfile, 'w') as f:
+        for entry in entries.values():
+            f.write(json.dumps(entry) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmpfile, term_file)
+    return entries
+
+def read_journal(path: Path) -> dict[int, dict[str, Any]]:
+    """Read the journal at PATH, returning the latest state of each course
+    keyed by canvas_course_id."""
+    return read_jsonl(path, 'canvas_course_id')
+
+def file_sha256(path: Path) -> str:
+    """Return the hex SHA-256 of the file at PATH, read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while block := f.read(1 << 16):
+            digest.update(block)
+    return digest.hexdigest()
+
+# How long a downloaded backup counts as finished
+MAX_AGE = timedelta(7)
+
+class Journal:
+    """The journal of one term's backup run.  Updates may come from
+    several threads at once."""
+    def __init__(self, path: Path):
+        self.path = path
+        self.entries = read_journal(path)
+        self.lock = threading.Lock()
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+    def get(self, canvas_id: int) -> dict[str, Any]:
+        return self.entries.get(canvas_id, {})
+
+    def update(self, canvas_id: int, /, **fields: Any) -> None:
+        """Record new FIELDS for the course with Canvas id CANVAS_ID."""
+        line = dict(fields, canvas_course_id=canvas_id,
+                    updated_at=datetime.now(timezone.utc).isoformat())
+        with self.lock:
+            self.entries[canvas_id] = dict(self.get(canvas_id), **line)
+            append_jsonl(self.path, line)
+
+    def downloaded(self, canvas_id: int, output_dir: Path) -> bool:
+        """Return True if the course's backup was downloaded and the file
+        is still in OUTPUT_DIR with the recorded size, however old it is."""
+        entry = self.get(canvas_id)
+        if entry.get('workflow_state') != 'downloaded':
+            return False
+        filepath = output_dir.joinpath(entry['file'])
+        return filepath.is_file() and filepath.stat().st_size == entry['size']
+
+    def finished(self, canvas_id: int, output_dir: Path) -> bool:
+        """Return True if the course's backup was downloaded (see
+        downloaded) from an export less than MAX_AGE old.  An older backup
+        is due to be exported again, as maybe_create_backup does with a
+        week-old export on Canvas."""
+        exported_at = self.get(canvas_id).get('exported_at')
+        if not exported_at or not self.downloaded(canvas_id, output_dir):
+            return False
+        exported = datetime.fromisoformat(exported_at.replace('Z', '+00:00'))
+        return timedelta(0) <= datetime.now(timezone.utc) - exported < MAX_AGE
+
+    def in_flight(self, canvas_id: int) -> bool:
+        """Return True if an export was started for the course but not yet
+        downloaded, so the run should go back to polling it."""
+        return self.get(canvas_id).get('workflow_state') in ('created', 'exporting', 'exported')
+
+class Manifest:
+    """Checksums of the cartridges downloaded for one term, keyed by
+    filename.  A file whose size and modification time still match its
+    entry is taken to be intact without reading it."""
+    def __init__(self, path: Path):
+        self.path = path
+        self.entries: dict[str, dict[str, Any]] = read_jsonl(path, 'file')
+        self.lock = threading.Lock()
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+    def record(self, filepath: Path, sha256: str) -> None:
+        """Record the checksum SHA256 of the file at FILEPATH."""
+        stat = filepath.stat()
+        entry = {'file': filepath.name, 'size': stat.st_size,
+                 'mtime_ns': stat.st_mtime_ns, 'sha256': sha256}
+        with self.lock:
+            self.entries[filepath.name] = entry
+            append_jsonl(self.path, entry)
+
+    def verified(self, filepath: Path, size: int) -> bool:
+        """Return True if the file at FILEPATH has a manifest entry, is SIZE
+        bytes long, and has not been touched since its checksum was taken."""
+        entry = self.entries.get(filepath.name)
+        if entry is None or not filepath.is_file():
+            return False
+        stat = filepath.stat()
+        return stat.st_size == size == entry['size'] and stat.st_mtime_ns == entry['mtime_ns']
+
+    def check(self, filepath: Path) -> bool:
+        """Re-read the file at FILEPATH and compare it with its recorded checksum."""
+        entry = self.entries.get(filepath.name)
+        return entry is not None and file_sha256(filepath) == entry['sha256']
@@ -0,0 +1,80 @@
+# Content-addressed store for course cartridges.  Each distinct cartridge
+# is kept once under store/<first two hex digits>/<sha256><suffix>, and
+# the per-term names that course_backups gives its files are hardlinks
+# to the stored copy.  Blueprint-derived and cross-listed courses often
+# export identical cartridges, so this saves a good deal of disk.
+# A cartridge that no name links to any more (its course was exported
+# again, or its term was moved off this machine) is pruned at the end of
+# each run.
+
+from pathlib import Path
+import os
+
+def store_dir(backups_dir: Path) -> Path:
+    return backups_dir.joinpath('store')
+
+def object_path(store: Path, sha256: str, suffix: str) -> Path:
+    """Return where the cartridge with checksum SHA256 lives in STORE."""
+    return store.joinpath(sha256[:2], sha256 + suffix)
+
+def store_file(filepath: Path, sha256: str, store: Path) -> bool:
+    """Put the file at FILEPATH into STORE under its checksum SHA256.  If
+    the store already holds that content, FILEPATH is replaced by a link
+    to it.  Returns True if FILEPATH was a duplicate.  Where hardlinks are
+    not possible (e.g. the store is on another filesystem), the file is
+    left as it is and only its manifest entry records the checksum."""
+    obj = object_path(store, sha256, filepath.suffix)
+    obj.parent.mkdir(parents=True, exist_ok=True)
+    if obj.exists() and obj.samefile(filepath):
+        return False
+    try:
+        os.link(filepath, obj)
+        return False
+    except FileExistsError:  # Already stored (perhaps by another thread)
+        pass
+    except OSError:
+        return False
+    if obj.stat().st_size != filepath.stat().st_size:  # Should never happen with SHA-256
+        return False
+    tmplink = filepath.with_name(filepath.name + '.link')
+    tmplink.unlink(missing_ok=True)
+    try:
+        os.link(obj, tmplink)
+    except FileNotFoundError:  # Pruned in the meantime, by another run
+        return store_file(filepath, sha256, store)
+    os.replace(tmplink, filepath)
+    return True
+
+def prune_store(store: Path) -> tuple[int, int]:
+    """Remove the cartridges in STORE that no name links to any more.
+    Returns how many were removed and the bytes freed."""
+    removed, freed = 0, 0
+    if store.is_dir():
+        for obj in store.glob('*/*'):
+            stat = obj.stat()
+            if stat.st_nlink == 1:
+                obj.unlink()
+                removed += 1
+                freed += stat.st_size
+    return removed, freed
+
+def dedup_report(store: Path) -> dict[str, int]:
+    """Summarise STORE: the number of distinct cartridges, how many names
+    link to them, the bytes they would take without the store and the
+    bytes they actually take.  Cartridges no name links to any more are
+    counted separately."""
+    report: dict[str, int] = {'objects': 0, 'names': 0, 'logical_bytes': 0,
+                              'stored_bytes': 0, 'unreferenced': 0}
+    if store.is_dir():
+        for obj in store.glob('*/*'):
+            stat = obj.stat()
+            names = stat.st_nlink - 1  # Every link other than the store's own
+            if names == 0:
+                report['unreferenced'] += 1
+                continue
+            report['objects'] += 1
+            report['names'] += names
+            report['logical_bytes'] += names * stat.st_size
+            report['stored_bytes'] += stat.st_size
+    report['saved_bytes'] = report['logical_bytes'] - report['stored_bytes']
+    return report
@@ -0,0 +1,288 @@
+# Shared client for the Canvas REST API.
+# Keeps a keep-alive connection per host (and per thread), so repeated
+# calls reuse one TLS session instead of forking curl every time.
+
+from http.client import HTTPConnection, HTTPException, HTTPResponse, HTTPSConnection
+from pathlib import Path
+from typing import Any, Iterator, Optional, Union, cast
+from urllib.parse import SplitResult, urlencode, urljoin, urlsplit
+import hashlib
+import json
+import os
+import re
+import threading
+import uuid
+
+# Type of the query parameters accepted by the request functions.  A list
+# of pairs is needed for repeated keys such as enrollment_type[].
+Params = Union[dict[str, Any], list[tuple[str, Any]]]
+
+# Set constants, using a dict instead of global variables
+def constants() -> dict[str, str]:
+    return { #'host': 'converse.beta.instructure.com',
+             'host': 'converse.instructure.com',
+             'tokenfile': 'tokens.json' }
+
+# The tokens file as last read, and its modification time then, so a
+# long-running process reads it again only when it changes.
+_tokens: dict[str, Any] = {}
+
+# Get the access token for the host we're using
+def get_access_token(suffix:str = '') -> str:
+    tokfile = Path.home().joinpath('.ssh', (constants()['tokenfile']))
+    mtime = tokfile.stat().st_mtime_ns
+    if _tokens.get('mtime') != mtime:
+        _tokens.update(mtime=mtime, data=json.loads(tokfile.read_text()))
+    data: dict[str, Any] = _tokens['data']
+    key: str = constants()['host'] + suffix
+    #print(key)
+    return cast(str, data[key])
+
+class IncompleteDownload(Exception):
+    """Raised when a download ends up a different size than expected."""
+
+class CanvasError(Exception):
+    """Raised when Canvas answers a request with an HTTP error status."""
+    def __init__(self, status: int, reason: str, url: str, body: str = ''):
+        super().__init__('{0} {1}: {2} {3}'.format(status, reason, url, body[:500]))
+        self.status = status
+        self.body = body
+
+CHUNK_SIZE = 1 << 16
+TIMEOUT = 300  # seconds
+MAX_REDIRECTS = 10
+
+# Connections are kept per thread, since http.client connections are not
+# safe to share between threads.
+_pool = threading.local()
+
+def api_url(path: str) -> str:
+    """Return the full URL for the Canvas API endpoint PATH (e.g. 'courses/1')."""
+    return 'https://{0}/api/v1/{1}'.format(constants()['host'], path.lstrip('/'))
+
+def _connection(parts: SplitResult, fresh: bool = False) -> HTTPConnection:
+    """Return the pooled connection for the scheme and host of PARTS,
+    opening a new one if there is none (or if FRESH is set)."""
+    conns: dict[tuple[str, str], HTTPConnection] = _pool.__dict__.setdefault('conns', {})
+    key = (parts.scheme, parts.netloc)
+    if fresh and key in conns:
+        conns.pop(key).close()
+    if key not in conns:
+        if parts.scheme == 'https':
+            conns[key] = HTTPSConnection(parts.netloc, timeout=TIMEOUT)
+        else:
+            conns[key] = HTTPConnection(parts.netloc, timeout=TIMEOUT)
+    return conns[key]
+
+def close_connections() -> None:
+    """Close every connection pooled by the calling thread."""
+    conns: dict[tuple[str, str], HTTPConnection] = _pool.__dict__.get('conns', {})
+    for conn in conns.values():
+        conn.close()
+    conns.clear()
+
+def _multipart(fields: Params, files: dict[str, Path]) -> tuple[str, int, Any]:
+    """Encode FIELDS and FILES as multipart/form-data, the way curl --form does.
+    Returns the content type, the content length, and a function producing
+    the body in chunks, so large files are never held in memory."""
+    boundary = uuid.uuid4().hex
+    items = fields.items() if isinstance(fields, dict) else fields
+    head = b''
+    for name, value in items:
+        head += ('--{0}\r\nContent-Disposition: form-data; name="{1}"\r\n\r\n{2}\r\n'
+                 .format(boundary, name, value)).encode('utf-8')
+    file_parts: list[tuple[bytes, Path]] = []
+    for name, path in files.items():
+        part = ('--{0}\r\nContent-Disposition: form-data; name="{1}"; filename="{2}"\r\n'
+                'Content-Type: application/octet-stream\r\n\r\n'
+                .format(boundary, name, path.name)).encode('utf-8')
+        file_parts.append((part, path))
+    tail = '--{0}--\r\n'.format(boundary).encode('utf-8')
+    length = len(head) + len(tail) + sum(len(p) + path.stat().st_size + 2 for p, path in file_parts)
+
+    def chunks() -> Iterator[bytes]:
+        yield head
+        for part, path in file_parts:
+            yield part
+            with open(path, 'rb') as f:
+                while block := f.read(CHUNK_SIZE):
+                    yield block
+            yield b'\r\n'
+        yield tail
+
+    return 'multipart/form-data; boundary=' + boundary, length, chunks
+
+# Methods that are safe to send twice.  A POST is not: once its body has
+# gone out, the server may have acted on it even though no answer came back.
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+
+def _send(method: str, url: str, headers: dict[str, str], body: Any = None) -> HTTPResponse:
+    """Send one request over the pooled connection, retrying once on a
+    fresh connection if the server had silently closed the old one.
+    Other requests are only retried if they failed before being sent."""
+    parts = urlsplit(url)
+    target = parts.path + ('?' + parts.query if parts.query else '')
+    for attempt in range(2):
+        conn = _connection(parts, fresh=(attempt > 0))
+        sent = False
+        try:
+            conn.request(method, target, body=body() if callable(body) else body, headers=headers)
+            sent = True
+            return conn.getresponse()
+        except (HTTPException, ConnectionError) as e:
+            conn.close()
+            if attempt > 0 or (sent and method not in IDEMPOTENT_METHODS):
+                raise e
+    raise AssertionError('unreachable')
+
+def request(method: str, url: str, params: Optional[Params] = None,
+            fields: Optional[Params] = None, files: Optional[dict[str, Path]] = None,
+            token: Optional[str] = None, extra_headers: Optional[dict[str, str]] = None,
+            json_body: Any = None) -> HTTPResponse:
+    """Make a request and return the response, with its body still unread.
+    PARAMS go in the query string; FIELDS and FILES make up a form body,
+    or else JSON_BODY (if not None) is sent encoded as JSON.
+    Redirects are followed, dropping the credentials when the host changes.
+    The caller must read the whole body before making another request."""
+    if params:
+        url = url + ('&' if '?' in url else '?') + urlencode(params, doseq=True)
+    if token is None:
+        token = get_access_token()
+    headers: dict[str, str] = dict(extra_headers or {}, Authorization='Bearer ' + token)
+    body: Any = None
+    if files:
+        content_type, length, body = _multipart(fields or {}, files)
+        headers['Content-Type'] = content_type
+        headers['Content-Length'] = str(length)
+    elif fields:
+        body = urlencode(fields, doseq=True).encode('utf-8')
+        headers['Content-Type'] = 'application/x-www-form-urlencoded'
+    elif json_body is not None:
+        body = json.dumps(json_body).encode('utf-8')
+        headers['Content-Type'] = 'application/json'
+
+    for _ in range(MAX_REDIRECTS):
+        response = _send(method, url, headers, body)
+        if response.status not in (301, 302, 303, 307, 308):
+            break
+        response.read()
+        location = urljoin(url, response.getheader('Location', ''))
+        if urlsplit(location).netloc != urlsplit(url).netloc:
+            headers.pop('Authorization', None)
+        if response.status == 303 or (response.status in (301, 302) and method == 'POST'):
+            method, body = 'GET', None
+            headers.pop('Content-Type', None)
+            headers.pop('Content-Length', None)
+        url = location
+    else:
+        raise CanvasError(response.status, 'Too many redirects', url)
+
+    if response.status >= 400:
+        raise CanvasError(response.status, response.reason, url,
+                          response.read().decode('utf-8', errors='replace'))
+    return response
+
+def get_json(url: str, params: Optional[Params] = None) -> Any:
+    """GET URL and return the decoded JSON response."""
+    return json.load(request('GET', url, params=params))
+
+def next_link(response: HTTPResponse) -> str:
+    """Return the rel="next" URL from the Link header of RESPONSE, or ''
+    if this is the last page."""
+    for link in (response.getheader('Link') or '').split(','):
+        match = re.match(r'\s*<([^>]*)>\s*;.*\brel="?next"?', link)
+        if match:
+            return match.group(1)
+    return ''
+
+def get_paginated(url: str, params: Optional[Params] = None) -> Iterator[Any]:
+    """GET the list endpoint at URL and yield its records one at a time,
+    following the Link headers Canvas uses for pagination.  Only one page
+    is held in memory at once, and pages after the first are only
+    requested if the caller keeps iterating."""
+    response = request('GET', url, params=params)
+    while True:
+        page: list[Any] = json.load(response)
+        url = next_link(response)
+        yield from page
+        if not url:
+            break
+        response = request('GET', url)
+
+def post_json(url: str, fields: Optional[Params] = None,
+              files: Optional[dict[str, Path]] = None) -> Any:
+    """POST a form made of FIELDS and FILES to URL and return the decoded JSON response."""
+    return json.load(request('POST', url, fields=fields or {}, files=files))
+
+def get_text(url: str) -> str:
+    """GET URL (following redirects) and return the body as a string."""
+    return request('GET', url).read().decode('utf-8')
+
+def download(url: str, outfile: Path) -> int:
+    """Stream the body at URL (following redirects) into OUTFILE.
+    Returns the number of bytes written."""
+    response = request('GET', url)
+    size = 0
+    with open(outfile, 'wb') as f:
+        while block := response.read(CHUNK_SIZE):
+            f.write(block)
+            size += len(block)
+        f.flush()
+        os.fsync(f.fileno())
+    return size
+
+def download_resumable(url: str, outfile: Path, expected_size: int, source: str,
+                       retries: int = 3) -> str:
+    """Download URL into OUTFILE by way of OUTFILE.part, resuming with an
+    HTTP Range request if a partial download of the same SOURCE (such as
+    an attachment id) is already there, from this run or an earlier one.
+    A partial download of anything else is thrown away, since OUTFILE's
+    name may be shared by different versions of the file.  The SHA-256 of
+    the file is computed while streaming.  Only when the size matches
+    EXPECTED_SIZE is the file renamed into place, so OUTFILE is never
+    left half-written.  Returns the hex digest."""
+    partfile = outfile.with_name(outfile.name + '.part')
+    sourcefile = outfile.with_name(outfile.name + '.part.source')
+    digest = hashlib.sha256()
+    size = 0
+    if partfile.exists() and (not sourcefile.is_file() or sourcefile.read_text() != source):
+        partfile.unlink()
+    sourcefile.write_text(source)
+    if partfile.exists():
+        with open(partfile, 'rb') as f:
+            while block := f.read(CHUNK_SIZE):
+                digest.update(block)
+                size += len(block)
+    if size > expected_size:  # Not the file we're after; start over
+        digest, size = hashlib.sha256(), 0
+
+    for attempt in range(retries + 1):
+        if size == expected_size:
+            break
+        try:
+            response = request('GET', url, extra_headers={'Range': 'bytes={0}-'.format(size)})
+            if response.status != 206:  # Range ignored, so the whole file is coming
+                digest, size = hashlib.sha256(), 0
+            with open(partfile, 'ab' if size > 0 else 'wb') as f:
+                while block := response.read(CHUNK_SIZE):
+                    f.write(block)
+                    digest.update(block)
+                    size += len(block)
+                f.flush()
+                os.fsync(f.fileno())
+        except (HTTPException, OSError) as e:
+            close_connections()
+            if attempt == retries:
+                raise e
+        if size > expected_size:
+            partfile.unlink()
+            raise IncompleteDownload('{0}: got {1} bytes, expected {2}'.format(
+                outfile.name, size, expected_size))
+
+    if size != expected_size:
+        raise IncompleteDownload('{0}: got {1} bytes, expected {2}'.format(
+            outfile.name, size, expected_size))
+    partfile.touch()  # In case the file is empty, so nothing was written
+    os.replace(partfile, outfile)
+    sourcefile.unlink()
+    return digest.hexdigest()
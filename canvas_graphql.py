@@ -0,0 +1,183 @@
+#! /usr/bin/python3
+
+# Batched lookups through the Canvas GraphQL API.  Where the REST API needs
+# one request per course, one GraphQL query can ask about many courses at
+# once by giving each its own alias (c0: course(id: "..."), c1: ...), so
+# looking up dozens of sections takes one or a few round trips.
+#
+# Run with --self-test to check the queries against a local stand-in for
+# Canvas, without touching the real server.
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Optional
+import json
+import re
+import sys
+import threading
+from canvas_api import CanvasError, close_connections, constants, request
+
+# Courses asked about in each query.  Canvas limits the complexity of a
+# query, so very long lists are split.
+BATCH_SIZE = 50
+
+COURSE_FIELDS = '_id name courseCode sisId workflowState term { name }'
+QUIZ_FIELDS = 'quizzesConnection(first: 100{0}) {{ nodes {{ _id title }} pageInfo {{ hasNextPage endCursor }} }}'
+
+class GraphQLError(Exception):
+    """Raised when Canvas answers a GraphQL query with errors."""
+    def __init__(self, errors: list[dict[str, Any]]):
+        super().__init__('; '.join(str(e.get('message', e)) for e in errors))
+        self.errors = errors
+
+def graphql_url() -> str:
+    return 'https://{0}/api/graphql'.format(constants()['host'])
+
+def quiz_fields(after: str = '') -> str:
+    return QUIZ_FIELDS.format(', after: "{0}"'.format(after) if after else '')
+
+class GraphQL:
+    """Client for the GraphQL endpoint at URL (by default, that of the
+    Canvas host in constants()).  TOKEN is only needed when it is not the
+    usual access token."""
+    def __init__(self, url: Optional[str] = None, token: Optional[str] = None):
+        self.url = url or graphql_url()
+        self.token = token
+        self.queries = 0
+
+    def query(self, text: str, variables: Optional[dict[str, Any]] = None) -> dict[str, Any]:
+        """Run the query TEXT and return its data."""
+        self.queries += 1
+        response = request('POST', self.url, token=self.token,
+                           json_body={'query': text, 'variables': variables or {}})
+        result: dict[str, Any] = json.load(response)
+        if result.get('errors'):
+            raise GraphQLError(result['errors'])
+        return result.get('data') or {}
+
+    def courses(self, by: str, keys: list[str], fields: str = COURSE_FIELDS) -> dict[str, Optional[dict[str, Any]]]:
+        """Look up the courses whose BY ('id' or 'sisId') is each of KEYS,
+        BATCH_SIZE to a query.  Returns each course's FIELDS keyed by the
+        key it was looked up with, or None where there is no such course."""
+        found: dict[str, Optional[dict[str, Any]]] = {}
+        for start in range(0, len(keys), BATCH_SIZE):
+            batch = keys[start:start + BATCH_SIZE]
+            text = 'query {\n' + ''.join('  c{0}: course({1}: {2}) {{ {3} }}\n'.format(
+                n, by, json.dumps(key), fields) for n, key in enumerate(batch)) + '}'
+            data = self.query(text)
+            for n, key in enumerate(batch):
+                found[key] = data.get('c{0}'.format(n))
+        return found
+
+    def courses_by_id(self, course_IDs: list[Any], fields: str = COURSE_FIELDS) -> dict[str, Optional[dict[str, Any]]]:
+        return self.courses('id', [str(id) for id in course_IDs], fields)
+
+    def courses_by_sis_id(self, sis_ids: list[str], fields: str = COURSE_FIELDS) -> dict[str, Optional[dict[str, Any]]]:
+        return self.courses('sisId', sis_ids, fields)
+
+    def course_quizzes(self, course_IDs: list[Any]) -> dict[str, list[dict[str, Any]]]:
+        """Return the (classic) quizzes of each of COURSE_IDS, keyed by
+        course id.  The rare course with more quizzes than fit on one page
+        has the rest fetched separately."""
+        found: dict[str, list[dict[str, Any]]] = {}
+        for id, course in self.courses_by_id(course_IDs, '_id ' + quiz_fields()).items():
+            if course is None:
+                found[id] = []
+                continue
+            connection = course['quizzesConnection']
+            found[id] = list(connection['nodes'])
+            while connection['pageInfo']['hasNextPage']:
+                more = self.courses_by_id([id], quiz_fields(connection['pageInfo']['endCursor']))[id]
+                assert more is not None
+                connection = more['quizzesConnection']
+                found[id].extend(connection['nodes'])
+        return found
+
+    def find_quizzes(self, course_IDs: list[Any], search_term: str) -> dict[str, int]:
+        """Find the quiz whose title contains SEARCH_TERM in each of
+        COURSE_IDS, as find_quiz_numbers in info_lit does over REST.
+        Returns the quiz id (0 where there is none) keyed by course id."""
+        quizzes: dict[str, int] = {}
+        for id, nodes in self.course_quizzes(course_IDs).items():
+            data = [quiz for quiz in nodes if search_term.lower() in quiz['title'].lower()]
+            if len(data) > 1:
+                print('WARNING: course {0} has {1} info-fluency quizzes. Data\n\t{2}'.format(id, len(data), data))
+            quizzes[id] = int(data[-1]['_id']) if data else 0
+        return quizzes
+
+# Stand-in for Canvas, for the self-test.  It understands just enough
+# GraphQL to answer the aliased course queries above.
+STAND_IN_COURSES: dict[str, dict[str, Any]] = {
+    str(100 + n): {'_id': str(100 + n), 'name': 'Section {0}'.format(n),
+                   'courseCode': 'SSS101.{0:02}'.format(n), 'sisId': 'SSS101.{0:02}-2526-FA'.format(n),
+                   'workflowState': 'available', 'term': {'name': 'Fall 2025'},
+                   'quizzes': [{'_id': str(1000 + 10 * n + q), 'title': title}
+                               for q, title in enumerate(['Syllabus quiz', 'Information-fluency quiz']
+                                                         if n % 5 else ['Syllabus quiz'])]}
+    for n in range(120)}
+
+class StandInHandler(BaseHTTPRequestHandler):
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+    def do_POST(self) -> None:
+        body: dict[str, Any] = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        data: dict[str, Any] = {}
+        for alias, by, key, fields in re.findall(r'(\w+): course\((id|sisId): "([^"]*)"\) \{ (.*) \}',
+                                                 body['query']):
+            course = next((c for c in STAND_IN_COURSES.values() if c['_id' if by == 'id' else 'sisId'] == key),
+                          None)
+            if course is None:
+                data[alias] = None
+            elif 'quizzesConnection' in fields:
+                data[alias] = {'_id': course['_id'], 'quizzesConnection': {
+                    'nodes': course['quizzes'], 'pageInfo': {'hasNextPage': False, 'endCursor': ''}}}
+            else:
+                data[alias] = {k: v for k, v in course.items() if k != 'quizzes'}
+        payload = json.dumps({'data': data}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+def self_test() -> int:
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        client = GraphQL('http://127.0.0.1:{0}/api/graphql'.format(server.server_port), token='test')
+        ids = sorted(STAND_IN_COURSES)
+        quizzes = client.find_quizzes(ids, 'information-fluency')
+        assert client.queries == 3, client.queries  # 120 courses in batches of 50
+        assert quizzes['105'] == 0 and quizzes['106'] == 1061, quizzes
+        assert sum(1 for q in quizzes.values() if q == 0) == 24
+
+        client.queries = 0
+        courses = client.courses_by_sis_id(['SSS101.07-2526-FA', 'NOSUCH-2526-FA'])
+        assert client.queries == 1
+        assert courses['NOSUCH-2526-FA'] is None
+        course = courses['SSS101.07-2526-FA']
+        assert course is not None and course['_id'] == '107' and course['term']['name'] == 'Fall 2025'
+        print('GraphQL self-test passed')
+    finally:
+        close_connections()
+        server.shutdown()
+        server.server_close()
+    return 0
+
+def main(argv: list[str]) -> int:
+    if '--self-test' in argv:
+        return self_test()
+    if len(argv) < 2:
+        print('Usage: {0} [--self-test] SIS_COURSE_ID...'.format(argv[0]))
+        return 2
+    try:
+        for key, course in GraphQL().courses_by_sis_id(argv[1:]).items():
+            print(key, course)
+    except (CanvasError, GraphQLError) as e:
+        print(e)
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -17,15 +17,33 @@ while getopts "c:w:h" ARG; do
 done
 #echo Crit: $CRIT
 STATDIR=/home/phbrown@converse.edu/bin/canvas_scripts
-STATFILE=${STATDIR}/converse.instructure.com-upload.txt
-FILE_CONTENTS=`/usr/bin/head --bytes=100 $STATFILE`
-#echo FILE_CONTENTS is "$FILE_CONTENTS"
-ALL_DIGITS="$(expr "$FILE_CONTENTS" : '^[0-9]\+$')"
-#echo ALL_DIGITS is "$ALL_DIGITS"
-MODTIME=`/bin/date  --reference=$STATFILE +%s`
-#echo Modtime: $MODTIME
-AGE=$((`/bin/date +%s` - $MODTIME))
-#echo age = $AGE
+# Heartbeats come every 10 seconds from the run holding the upload lock
+HEARTBEAT_STALE=60
+
+# json_field JSON NAME VAR: set VAR to the value of NAME in the one-line
+# JSON object JSON.  Bash builtins only, so nothing is forked.
+json_field() {
+    local PATTERN="\"$2\": (\"([^\"]*)\"|(-?[0-9]+))"
+    if [[ $1 =~ $PATTERN ]]; then
+        printf -v "$3" '%s' "${BASH_REMATCH[2]}${BASH_REMATCH[3]}"
+    fi
+}
+
+# The heartbeat record of the upload runs (see upload_lock.py)
+UPLOADFILE=${STATDIR}/converse.instructure.com-upload.json
+UPLOAD=""
+if [ -f $UPLOADFILE ]; then
+    read -r UPLOAD < $UPLOADFILE
+fi
+U_STATE=""
+json_field "$UPLOAD" state U_STATE
+json_field "$UPLOAD" pid U_PID
+json_field "$UPLOAD" stage U_STAGE
+json_field "$UPLOAD" last_upload U_LAST
+json_field "$UPLOAD" started U_STARTED
+json_field "$UPLOAD" heartbeat U_BEAT
+json_field "$UPLOAD" message U_MSG
+printf -v NOW '%(%s)T' -1
 
 # Check for stale input data.
 # This will warn if *any* input file is stale (older than the threshold)
@@ -54,6 +72,23 @@ for f in $INPUTDIR/*.csv ; do
     #echo $OLDEST_INPUT
 done
 
+# A long-running csv_update (--daemon or --watch) also keeps its status
+# in a one-line JSON file (see sync_status.py)
+STATUSFILE=${STATDIR}/converse.instructure.com-status.json
+STATUS=""
+if [ -f $STATUSFILE ]; then
+    read -r STATUS < $STATUSFILE
+fi
+D_STATE=""
+json_field "$STATUS" state D_STATE
+json_field "$STATUS" pid D_PID
+json_field "$STATUS" mode D_MODE
+json_field "$STATUS" next_cycle D_NEXT
+json_field "$STATUS" message D_MSG
+# A daemon retries failed cycles itself; otherwise autofix reruns the job
+if [ -n "$D_STATE" ] && [ "$D_STATE" != "stopped" ]; then
+    DAEMON=yes
+fi
 
 if [ $NEWEST_INPUT -gt $STALE_INPUT_THRESHOLD ]; then
     echo "CRITICAL - Newest input file is aged $NEWEST_INPUT sec"
@@ -61,14 +96,45 @@ if [ $NEWEST_INPUT -gt $STALE_INPUT_THRESHOLD ]; then
 elif [ $OLDEST_INPUT -gt $STALE_INPUT_THRESHOLD ]; then
     echo "WARN - Stale input file aged $OLDEST_INPUT sec"
     exit $STATE_WARNING
-elif [ "$ALL_DIGITS" != "0" ]; then
-    echo "OK - Last upload was $FILE_CONTENTS"
-    exit $STATE_OK;
-elif [ $AGE -gt $CRIT ]; then
-    echo "WARN - $FILE_CONTENTS - for $AGE sec"
+elif [ -z "$U_STATE" ]; then
+    echo "WARN - No record of any upload run in $UPLOADFILE"
     exit $STATE_WARNING
-else
-    ${STATDIR}/autofix.py &
-    echo "CRITICAL - $FILE_CONTENTS"
+elif [ "$U_STATE" == "working" ] && [ ! -d /proc/$U_PID ]; then
+    [ -z "$DAEMON" ] && ${STATDIR}/autofix.py &
+    echo "CRITICAL - Upload run (pid $U_PID) died while $U_STAGE; last upload was $U_LAST"
+    exit $STATE_CRITICAL
+elif [ "$U_STATE" == "working" ] && [ $((NOW - U_BEAT)) -gt $HEARTBEAT_STALE ]; then
+    echo "CRITICAL - Upload run (pid $U_PID) has had no heartbeat for $((NOW - U_BEAT)) sec while $U_STAGE"
     exit $STATE_CRITICAL
+elif [ "$U_STATE" == "working" ] && [ $((NOW - U_STARTED)) -gt $CRIT ]; then
+    echo "WARN - Upload run working for $((NOW - U_STARTED)) sec, now $U_STAGE"
+    exit $STATE_WARNING
+elif [ "$U_STATE" == "illegal_state" ]; then
+    echo "CRITICAL - $U_MSG (see upload_lock.py --clear)"
+    exit $STATE_CRITICAL
+elif [ "$U_STATE" == "failed" ]; then
+    [ -z "$DAEMON" ] && ${STATDIR}/autofix.py &
+    echo "CRITICAL - Last upload run failed: $U_MSG"
+    exit $STATE_CRITICAL
+elif [ "$U_STATE" == "timed_out" ]; then
+    echo "WARN - $U_MSG"
+    exit $STATE_WARNING
+elif [ -n "$DAEMON" ] && [ ! -d /proc/$D_PID ]; then
+    echo "CRITICAL - csv_update --$D_MODE (pid $D_PID) is not running"
+    exit $STATE_CRITICAL
+elif [ "$D_STATE" == "failed" ]; then
+    echo "CRITICAL - Last cycle failed: $D_MSG"
+    exit $STATE_CRITICAL
+elif [ "$D_STATE" == "idle" ] && [ "$D_NEXT" -gt 0 ] && [ $((NOW - D_NEXT)) -gt $CRIT ]; then
+    echo "CRITICAL - Cycle overdue by $((NOW - D_NEXT)) sec"
+    exit $STATE_CRITICAL
+elif [ "$U_STATE" == "interrupted" ]; then
+    echo "OK - Upload run was stopped ($U_MSG); last upload was $U_LAST"
+    exit $STATE_OK
+elif [ "$U_STATE" == "working" ]; then
+    echo "OK - Upload run $U_STAGE; last upload was $U_LAST"
+    exit $STATE_OK
+else
+    echo "OK - Last upload was $U_LAST"
+    exit $STATE_OK
 fi
@@ -2,53 +2,73 @@
 
 # Functions for performing course backups
 
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from datetime import datetime, timedelta, timezone
+from functools import partial
 from pathlib import Path
-from typing import Any, cast
+from typing import Any, Optional, cast
 from urllib.parse import ParseResult, parse_qs, urlparse, urlunparse
 import argparse
-import json
-import subprocess
+import hashlib
 import sys
 import time
+from backup_journal import Journal, Manifest, file_sha256, journal_file, manifest_file, merge_jsonl
+from backup_store import dedup_report, prune_store, store_dir, store_file
+from canvas_api import api_url, download_resumable, get_json, get_paginated, post_json
+from poller import Poller, wait_for
+from filter_csv import write_outfile
 from read_courses import print_course, read_course_list
-from upload_csv import constants, get_access_token, bytesOrStrPrintable
 
 def start_course_backup(course_ID: int) -> dict[str, Any]:
     """Initiate a course backup for COURSE.  Return the result of the course backup, as a dictionary."""
-    token = get_access_token()
-    cmd = ['curl', '--no-progress-meter', '--show-error', 
-            '--header', 'Authorization: Bearer ' + token,
-            '--form', 'export_type=common_cartridge',
-            '--form', 'skip_notifications=true',
-            'https://{0}/api/v1/courses/{1}/content_exports'.format(constants()['host'],
-                                                                    course_ID)]
-    output:str = bytesOrStrPrintable(subprocess.check_output(cmd))
-    #print(output)
-    data: dict[str, Any] = json.loads(output)
+    data: dict[str, Any] = post_json(api_url('courses/{0}/content_exports'.format(course_ID)),
+                                     fields={'export_type': 'common_cartridge',
+                                             'skip_notifications': 'true'})
+    #print(data)
     return data
 
 def check_for_backup(course_id: int) -> dict[str, Any]:
-    """Find out whether Canvas has a completed backup for the given COURSE_ID."""
+    """Find out whether Canvas has a completed backup for the given COURSE_ID.
+    Returns the most recent common-cartridge export, or {} if there is none.
+    This is for discovering an existing export; once its id is known, poll
+    it with get_export instead."""
     result: dict[str, Any] = {}
-    token = get_access_token()
-    cmd = ['curl', '--no-progress-meter', '--show-error', 
-            '--header', 'Authorization: Bearer ' + token,
-            'https://{0}/api/v1/courses/{1}/content_exports'.format(constants()['host'],
-                                                                    course_id)]
-    output: str = bytesOrStrPrintable(subprocess.check_output(cmd))
-    data: list[dict[str, Any]] = json.loads(output)
-    if len(data) > 0:
-        result = data[0]
+    exports = get_paginated(api_url('courses/{0}/content_exports'.format(course_id)),
+                            params={'per_page': 1})
+    # Exports of other types (e.g. QTI) may come first; later pages are
+    # only fetched if no common-cartridge export has turned up yet.
+    for export in exports:
+        if export.get('export_type') == 'common_cartridge':
+            result = export
+            break
     return result
 
+def get_export(course_id: int, export_id: int) -> dict[str, Any]:
+    """Get the content export EXPORT_ID of the course COURSE_ID."""
+    data: dict[str, Any] = get_json(api_url('courses/{0}/content_exports/{1}'.format(course_id,
+                                                                                    export_id)))
+    return data
+
+def poll_export(course_id: int, export_id: Optional[int]) -> dict[str, Any]:
+    """Get the current state of the export for COURSE_ID: by EXPORT_ID if
+    it is known (one small object), or else by finding the latest one."""
+    if export_id is None:
+        return check_for_backup(course_id)
+    return get_export(course_id, export_id)
+
+def parse_time(ISO_timestring: str) -> datetime:
+    """Takes a datetime string in ISO format, as Canvas writes them, and
+    returns the corresponding (timezone-aware) datetime."""
+    if ISO_timestring.endswith('Z'):
+        ISO_timestring = ISO_timestring[:-1] + '+00:00'
+    return datetime.fromisoformat(ISO_timestring)
+
 def recent(ISO_timestring: str) -> bool:
     """Takes a datetime string in ISO format, and returns True if it is sufficiently
     recent.  For this purpose "sufficiently recent" means less than a week old."""
     result = True
-    if ISO_timestring.endswith('Z'):
-        ISO_timestring = ISO_timestring[:-1] + '+00:00'
-    then: datetime = datetime.fromisoformat(ISO_timestring)
+    then: datetime = parse_time(ISO_timestring)
     now: datetime = datetime.now(timezone.utc)
 
     if then > now:
@@ -60,15 +80,60 @@ def recent(ISO_timestring: str) -> bool:
 
     return result
 
-def maybe_create_backup(course_id: int) -> dict[str, Any]:
+def course_last_activity(course_id: int) -> Optional[datetime]:
+    """Return the last time anyone did anything in the course with
+    COURSE_ID, going by the enrollments' last activity (which covers
+    teachers editing content as well as students working), or None if
+    there has been no activity at all."""
+    latest: Optional[datetime] = None
+    enrollments = get_paginated(api_url('courses/{0}/enrollments'.format(course_id)),
+                                params=[('per_page', 100)] +
+                                       [('state[]', state) for state in
+                                        ('active', 'invited', 'completed', 'inactive')])
+    for enrollment in enrollments:
+        for field in ('last_activity_at', 'updated_at'):
+            if enrollment.get(field):
+                when = parse_time(enrollment[field])
+                if latest is None or when > latest:
+                    latest = when
+    return latest
+
+def archived_cartridge(output_dir: Path, course: dict[str, Any],
+                       journal: Journal) -> Optional[tuple[Path, datetime]]:
+    """Find the cartridge already on disk for COURSE, if any.  Returns its
+    path and the time it was exported, as recorded in the JOURNAL.  A
+    cartridge whose export time is not known (a file's modification time
+    is when it was downloaded, later than the export) is not returned, so
+    the course is taken to have changed."""
+    entry = journal.get(course['canvas_course_id'])
+    if journal.downloaded(course['canvas_course_id'], output_dir) and entry.get('exported_at'):
+        return output_dir.joinpath(entry['file']), parse_time(entry['exported_at'])
+    return None
+
+def changed_since_archive(output_dir: Path, course: dict[str, Any],
+                          journal: Journal) -> tuple[bool, Optional[datetime]]:
+    """Return whether COURSE has changed since its cartridge on disk was
+    exported (True if there is no such cartridge), and the last activity
+    in the course, if it was looked up."""
+    archived = archived_cartridge(output_dir, course, journal)
+    if archived is None:
+        return True, None
+    last_activity = course_last_activity(course['canvas_course_id'])
+    return last_activity is not None and last_activity >= archived[1], last_activity
+
+def maybe_create_backup(course_id: int, changed_at: Optional[datetime] = None) -> dict[str, Any]:
     """Poll Canvas to see when the given BACKUP_ID for the given COURSE_ID is complete.
-    Effectively busy-wait until it does complete, albeit with a maximum number of tries."""
+    Effectively busy-wait until it does complete, albeit with a maximum number of tries.
+    An existing export made before CHANGED_AT (the course's last activity) is out of
+    date, so a new one is started."""
 
     # Does the backup already exist?
     data: dict[str, Any] = check_for_backup(course_id)
     if 'export_type' not in data or 'created_at' not in data \
             or data['export_type'] != 'common_cartridge' \
-            or not recent(data['created_at']):  # No usable backup exists for this course
+            or not recent(data['created_at']) \
+            or (changed_at is not None and parse_time(data['created_at']) <= changed_at):
+        # No usable backup exists for this course
         print('starting backup', end='', flush=True)
         data = start_course_backup(course_id)
     elif 'attachment' in data and data['workflow_state'] == 'exported':
@@ -78,57 +143,252 @@ def maybe_create_backup(course_id: int) -> dict[str, Any]:
 
     return data
 
-def wait_for_completion(course_id: int) -> dict[str, Any]:
-    completed = False
-    max_tries = 90
-    tries: int = 0
-    delay = 12
-    data = {}
-    
-    while not completed:
-        data = check_for_backup(course_id)
-        if 'attachment' in data and data['export_type'] == 'common_cartridge' and data['workflow_state'] == 'exported':
-            completed = True
-            break
+def backup_ready(data: dict[str, Any]) -> bool:
+    """Return True if the export DATA is a finished common-cartridge backup."""
+    return 'attachment' in data and data.get('export_type') == 'common_cartridge' \
+        and data.get('workflow_state') == 'exported'
 
-        time.sleep(delay)
-        tries += 1
-        endstr = ''
-        if tries % (60 // delay) == 0:
-            endstr = ' '
-        print('.', end=endstr, flush=True)
+# Polling parameters for content exports, which report no progress of their
+# own: start at 5 seconds and back off to one poll a minute.
+def export_polling() -> dict[str, Any]:
+    return { 'min_delay': 5, 'max_delay': 60, 'max_wait': 90 * 12 }
 
-        if tries >= max_tries:
-            raise Exception("Maximum tries exceeded")
+def wait_for_completion(course_id: int, export_id: Optional[int] = None) -> dict[str, Any]:
+    def check() -> dict[str, Any]:
+        print('.', end='', flush=True)
+        return poll_export(course_id, export_id)
 
+    data = wait_for(check, backup_ready, key=course_id, **export_polling())
     print(' ', end='', flush=True)
     # if not data['attachment']:
     #     print(data)    
     return cast(dict[str, Any], data['attachment'])
 
-def maybe_download_backup(term: str, output_dir: Path, course: dict[str, Any]) -> None:
-    """If the file doesn't already exist, download the backup file and store
-       it in the proper directory with the right filename."""
-    backup_data = wait_for_completion(course['canvas_course_id'])
-    
-    filename = term + '_' + course['course_id'].replace('/', '+') + '_' + backup_data['filename']
+def start_or_resume_backup(term: str, course: dict[str, Any], output_dir: Path,
+                           journal: Journal, incremental: bool = False) -> bool:
+    """Make sure an export is under way for COURSE, unless the JOURNAL shows
+       the course is backed up already.  An export the journal shows as in
+       flight is picked up again rather than started afresh.  If INCREMENTAL
+       is set, a course is backed up already if there has been no activity
+       since its cartridge on disk was exported, and is exported again if
+       there has, however recent the cartridge.  Returns False if there is
+       nothing left to do for this course."""
+    course_id: int = course['canvas_course_id']
+    changed_at: Optional[datetime] = None
+    if journal.in_flight(course_id):
+        print('resuming', end=' ', flush=True)
+        return True
+    if incremental:
+        changed, changed_at = changed_since_archive(output_dir, course, journal)
+        if not changed:
+            print('unchanged since last backup', end='', flush=True)
+            return False
+    elif journal.finished(course_id, output_dir):
+        print('finished already', end='', flush=True)
+        return False
+    data = maybe_create_backup(course_id, changed_at)
+    journal.update(course_id, course_id=course['course_id'], export_id=data.get('id'),
+                   workflow_state=data.get('workflow_state'),
+                   exported_at=data.get('created_at'))
+    return True
+
+def backup_filename(term: str, course: dict[str, Any], backup_data: dict[str, Any]) -> str:
+    """Return the local filename for the backup of COURSE described by BACKUP_DATA."""
+    return term + '_' + course['course_id'].replace('/', '+') + '_' + backup_data['filename']
+
+def download_backup(term: str, output_dir: Path, course: dict[str, Any],
+                    backup_data: dict[str, Any], manifest: Manifest) -> str:
+    """Download the backup file described by BACKUP_DATA (the export's
+       attachment) into OUTPUT_DIR, unless an intact copy is already there,
+       and record its checksum in MANIFEST.  An interrupted download is
+       resumed rather than started over.  The file goes into the content-
+       addressed store, so a duplicate of a cartridge already there ends
+       up as a link to it.  Returns a short description of what was done."""
+    filename = backup_filename(term, course, backup_data)
     filepath = output_dir.joinpath(filename)
 
+    if manifest.verified(filepath, backup_data['size']):
+        return 'downloaded already'
     if filepath.exists() and filepath.stat().st_size == backup_data['size']:
-        print('downloaded already')
-    else:
-        urlparts: ParseResult = cast(ParseResult, urlparse(backup_data['url']))
-        queryparts = parse_qs(urlparts.query)
-        url = urlunparse([urlparts.scheme, urlparts.netloc, urlparts.path, '',
-                                'verifier=' + queryparts['verifier'][0], ''])
-        token = get_access_token()
-        cmd: list[str] = ['curl', '--no-progress-meter', '--show-error', '--location',
-                '--header', 'Authorization: Bearer ' + token, 
-                '--output-dir', str(output_dir), '--output', filename, url]
-        # print(cmd)
-        print('downloading', end=' ', flush=True)
-        output: str = bytesOrStrPrintable(subprocess.check_output(cmd))
-        print(output)
+        # Downloaded before the manifest was kept
+        store_backup(filepath, file_sha256(filepath), output_dir, manifest)
+        return 'downloaded already, checksum recorded'
+
+    urlparts: ParseResult = cast(ParseResult, urlparse(backup_data['url']))
+    queryparts = parse_qs(urlparts.query)
+    url = urlunparse([urlparts.scheme, urlparts.netloc, urlparts.path, '',
+                            'verifier=' + queryparts['verifier'][0], ''])
+    # print(url)
+    sha256: str = download_resumable(url, filepath, backup_data['size'], str(backup_data['id']))
+    if store_backup(filepath, sha256, output_dir, manifest):
+        return 'downloaded {0} bytes, duplicate'.format(backup_data['size'])
+    return 'downloaded {0} bytes'.format(backup_data['size'])
+
+def store_backup(filepath: Path, sha256: str, output_dir: Path, manifest: Manifest) -> bool:
+    """Put the file at FILEPATH into the store under OUTPUT_DIR and record
+    its checksum in MANIFEST.  Returns True if it was a duplicate."""
+    duplicate: bool = store_file(filepath, sha256, store_dir(output_dir))
+    manifest.record(filepath, sha256)  # After linking, which may change the mtime
+    return duplicate
+
+def dedup_backups(output_dir: Path, manifest: Manifest) -> int:
+    """Put every file in MANIFEST that is still in OUTPUT_DIR into the
+    store, linking duplicates together.  Returns the number of duplicates."""
+    duplicates: int = 0
+    for filename, entry in sorted(manifest.entries.items()):
+        filepath = output_dir.joinpath(filename)
+        if filepath.is_file():
+            duplicates += store_backup(filepath, entry['sha256'], output_dir, manifest)
+    return duplicates
+
+def prune_backups(output_dir: Path) -> None:
+    """Free the space of the stored cartridges no backup file uses any more."""
+    removed, freed = prune_store(store_dir(output_dir))
+    print('Pruned', removed, 'unreferenced cartridges,', freed, 'bytes')
+
+def print_dedup_report(output_dir: Path) -> None:
+    report: dict[str, int] = dedup_report(store_dir(output_dir))
+    print('{names} files share {objects} stored cartridges: {logical_bytes} bytes in '
+          '{stored_bytes}, saving {saved_bytes} ({unreferenced} unreferenced)'.format(**report))
+
+def record_download(journal: Journal, term: str, course: dict[str, Any],
+                    backup_data: dict[str, Any]) -> None:
+    """Note in the JOURNAL that the backup of COURSE is safely on disk."""
+    journal.update(course['canvas_course_id'], workflow_state='downloaded',
+                   file=backup_filename(term, course, backup_data), size=backup_data['size'])
+
+def maybe_download_backup(term: str, output_dir: Path, course: dict[str, Any],
+                          journal: Journal, manifest: Manifest) -> None:
+    """If the file doesn't already exist, download the backup file and store
+       it in the proper directory with the right filename."""
+    backup_data = wait_for_completion(course['canvas_course_id'],
+                                      journal.get(course['canvas_course_id']).get('export_id'))
+    journal.update(course['canvas_course_id'], workflow_state='exported')
+    print(download_backup(term, output_dir, course, backup_data, manifest))
+    record_download(journal, term, course, backup_data)
+
+def verify_backups(output_dir: Path, manifest: Manifest) -> int:
+    """Re-read every file in MANIFEST and compare it with its checksum.
+       Returns the number of files that are missing or do not match."""
+    bad: int = 0
+    for filename in sorted(manifest.entries.keys()):
+        filepath = output_dir.joinpath(filename)
+        if not filepath.is_file() or not manifest.check(filepath):
+            print('BAD', filename, flush=True)
+            bad += 1
+    return bad
+
+def backup_concurrently(term: str, output_dir: Path, courselist: list[dict[str, Any]],
+                        jobs: int, journal: Journal, manifest: Manifest,
+                        incremental: bool = False) -> int:
+    """Back up every course in COURSELIST, keeping up to JOBS exports in
+       flight on Canvas, polling them together, and running up to JOBS
+       downloads at once.  Progress is recorded in JOURNAL and checksums
+       in MANIFEST.  INCREMENTAL is passed on to start_or_resume_backup.
+       Returns the number of courses that failed."""
+    waiting: deque[dict[str, Any]] = deque(courselist)
+    courses: dict[int, dict[str, Any]] = {c['canvas_course_id']: c for c in courselist}
+    downloads: dict[Future[str], tuple[dict[str, Any], dict[str, Any]]] = {}
+    failures: int = 0
+
+    with ThreadPoolExecutor(jobs) as pollers, ThreadPoolExecutor(jobs) as downloaders:
+        exports = Poller(pollers)
+        while waiting or exports or downloads:
+            # Start (or find) exports until JOBS are in flight
+            while waiting and len(exports) < jobs:
+                c = waiting.popleft()
+                print_course(c, ': ')
+                try:
+                    started = start_or_resume_backup(term, c, output_dir, journal, incremental)
+                except Exception as e:  # A Canvas error or timeout; go on with the others
+                    failures += 1
+                    print('could not start export:', e, flush=True)
+                    continue
+                print(flush=True)
+                if started:
+                    exports.add(c['canvas_course_id'],
+                                partial(poll_export, c['canvas_course_id'],
+                                        journal.get(c['canvas_course_id']).get('export_id')),
+                                lambda data: backup_ready(data) or data.get('workflow_state') == 'failed',
+                                **export_polling())
+
+            # Poll the exports that are due
+            for job in exports.poll():
+                c = courses[job.key]
+                if job.error is not None:
+                    # Left in flight in the journal, so the next run picks it up
+                    failures += 1
+                    print_course(c, ': ')
+                    print('polling failed:', job.error, flush=True)
+                elif job.timed_out:
+                    # It may yet finish on Canvas, so it too is left in flight
+                    failures += 1
+                    print_course(c, ': ')
+                    print('export timed out while', job.status.get('workflow_state', 'missing'), flush=True)
+                elif backup_ready(job.status):
+                    journal.update(job.key, workflow_state='exported')
+                    downloads[downloaders.submit(download_backup, term, output_dir,
+                                                 c, job.status['attachment'], manifest)] = \
+                        (c, job.status['attachment'])
+                else:
+                    journal.update(job.key, workflow_state='failed')
+                    failures += 1
+                    print_course(c, ': ')
+                    print('export', job.status.get('workflow_state', 'missing'), flush=True)
+
+            # Wait for the next poll, reporting downloads as they finish
+            delay = exports.next_delay()
+            if downloads:
+                done, _ = wait(list(downloads.keys()), timeout=delay, return_when=FIRST_COMPLETED)
+                for future in done:
+                    c, backup_data = downloads.pop(future)
+                    print_course(c, ': ')
+                    try:
+                        print(future.result(), flush=True)
+                        record_download(journal, term, c, backup_data)
+                    except Exception as e:
+                        failures += 1
+                        print('download failed:', e, flush=True)
+            elif delay:
+                time.sleep(delay)
+
+    return failures
+
+def parse_shard(spec: str) -> tuple[int, int]:
+    """Parse a shard specification 'i/n' (1 <= i <= n)."""
+    try:
+        index, count = (int(part) for part in spec.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError("shard must look like 'i/n'")
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError('shard must have 1 <= i <= n')
+    return index, count
+
+def in_shard(course: dict[str, Any], shard: tuple[int, int]) -> bool:
+    """Return True if COURSE belongs to SHARD (i, n).  Courses are assigned
+    by a hash of canvas_course_id, so every worker computes the same split
+    without talking to the others, whatever order the course list is in."""
+    digest = hashlib.sha256(str(course['canvas_course_id']).encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') % shard[1] == shard[0] - 1
+
+def merge_shards(term: str, backups_dir: Path) -> Path:
+    """Fold the per-shard journals and manifests for TERM into the term's
+    own, and write a report of every course's backup to the reports
+    directory.  Returns the path of the report."""
+    journal = merge_jsonl(journal_file(backups_dir, term), 'canvas_course_id')
+    manifest = merge_jsonl(manifest_file(backups_dir, term), 'file')
+    fields = ('canvas_course_id', 'course_id', 'workflow_state', 'export_id',
+              'exported_at', 'file', 'size', 'sha256', 'updated_at')
+    rows: list[dict[str, str]] = []
+    for entry in sorted(journal.values(), key=lambda e: str(e.get('course_id', ''))):
+        entry = dict(entry, sha256=manifest.get(entry.get('file'), {}).get('sha256', ''))
+        rows.append({field: str(entry.get(field) or '') for field in fields})
+    report = backups_dir.joinpath('reports', term + '-backup_report.csv')
+    if rows:
+        write_outfile(rows, report)
+    states = [row['workflow_state'] for row in rows]
+    print(states.count('downloaded'), 'of', len(rows), 'courses downloaded')
+    return report
 
 # def get_course_backup(term: str, course: dict) -> None:
 #     backup_data = create_or_find_backup(course['canvas_course_id'])
@@ -139,6 +399,18 @@ def parse_args(argv: list[str]) -> dict[str, Any]:
     parser.add_argument('term', help='Term to back up')
     parser.add_argument('--start', default=0, type=int, 
                         help='Ordinal number (not ID) of course to start at')
+    parser.add_argument('--jobs', default=1, type=int,
+                        help='Number of courses to export and download at once')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Skip courses with no activity since their cartridge on disk was exported')
+    parser.add_argument('--shard', type=parse_shard, default=None,
+                        help="Back up only shard i of n (e.g. '2/4'), with its own journal and manifest")
+    parser.add_argument('--merge', action='store_true',
+                        help='Merge the per-shard journals and manifests and write a term report')
+    parser.add_argument('--dedup', action='store_true',
+                        help="Link the term's duplicate cartridges through the store, prune the unused ones and report the bytes saved")
+    parser.add_argument('--verify', action='store_true',
+                        help="Re-read the term's downloaded files and check them against the manifest")
     args = parser.parse_args(argv)
     return vars(args)
 
@@ -148,27 +420,62 @@ def main(argv: list[str]) -> int:
     term: str = cast(str, args['term'])
 
     backups_dir = Path.home().joinpath('Documents', 'DEd', 'course_backups')
+    if args['merge']:
+        merge_shards(term, backups_dir)
+        return 0
+
+    shard: Optional[tuple[int, int]] = args['shard']
+    manifest = Manifest(manifest_file(backups_dir, term, shard))
+    if args['verify']:
+        bad: int = verify_backups(backups_dir, manifest)
+        print(bad, 'of', len(manifest.entries), 'files bad')
+        return 0 if bad == 0 else 1
+    if args['dedup']:
+        print(dedup_backups(backups_dir, manifest), 'duplicates linked')
+        prune_backups(backups_dir)
+        print_dedup_report(backups_dir)
+        return 0
     
     courselist: list[dict[str, Any]] = read_course_list(term, Path.joinpath(backups_dir, 'reports'))
     print(len(courselist), 'courses')
+    if shard is not None:
+        courselist = [c for c in courselist if in_shard(c, shard)]
+        print(len(courselist), 'courses in shard {0}/{1}'.format(*shard))
     # print_courses(courselist)
 
     print(time.asctime(), flush=True)
     #courselist = courselist[350:360]
 
+    # The journal lets a restarted run skip finished courses and go back
+    # to polling exports that were already under way.
+    journal = Journal(journal_file(backups_dir, term, shard))
+    print(sum(journal.finished(c['canvas_course_id'], backups_dir) for c in courselist),
+          'courses finished already', flush=True)
+
     i: int = cast(int, args['start'])
-    while i < len(courselist):
-        print(i, end=' ')
-        c = courselist[i]
-        print_course(c, ': ')
-        maybe_create_backup(c['canvas_course_id'])
-        maybe_download_backup(term, backups_dir, c)
-        i += 1
+    jobs: int = cast(int, args['jobs'])
+    failures: int = 0
+    if jobs > 1:
+        failures = backup_concurrently(term, backups_dir, courselist[i:], jobs, journal, manifest,
+                                       args['incremental'])
+        print(failures, 'courses failed')
+    else:
+        while i < len(courselist):
+            print(i, end=' ')
+            c = courselist[i]
+            print_course(c, ': ')
+            if start_or_resume_backup(term, c, backups_dir, journal, args['incremental']):
+                maybe_download_backup(term, backups_dir, c, journal, manifest)
+            else:
+                print()
+            i += 1
     # for c in courselist:
     #     print_course(c, ': ')
 
+    prune_backups(backups_dir)
+    print_dedup_report(backups_dir)
     print(time.asctime(), flush=True)
-    return 0
+    return 0 if failures == 0 else 1
 
 if __name__ == '__main__':
     sys.exit(main(sys.argv))
\ No newline at end of file
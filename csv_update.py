@@ -4,10 +4,23 @@
 # Input comes from one CSV file, and output is written to another.
 # Peter Brown <peter.brown@converse.edu>, 2020-08-04
 
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import nullcontext
 from pathlib import Path
+from typing import Any, Optional
+import argparse
+import os
+import signal
 import sys
-from filter_csv import filter_csv, stem_list
-from upload_csv import get_last_upload, write_last_upload, upload
+import time
+import traceback
+from dir_watch import watch
+from filter_csv import filter_pool, report_timings, start_filters, stem_list, StemFilter
+from input_manifest import InputManifest, stem_inputs
+from sync_status import SyncStatus
+from upload_csv import confirm_upload, interrupted_prefix, upload, upload_bundle
+from upload_lock import UploadLock
 
 # ------------------- filtering ----------------------------------------
 
@@ -23,29 +36,223 @@ def get_data_dirs() -> dict[str, Path]:
 
 ## ----- uploading --------------------------------------------------
 
-def main(argv:list[str]) -> int:
-    datadirs:dict[str, Path] = get_data_dirs()
-    filters = stem_list()
-    try:
-        last_upload:int = get_last_upload(datadirs['outputdir'])
+def parse_args(argv: list[str]) -> dict[str, Any]:
+    parser = argparse.ArgumentParser(prog='csv_update.py')
+    parser.add_argument('--upload-only', action='store_true',
+                        help='Upload the files already filtered, without filtering again')
+    parser.add_argument('--full', action='store_true',
+                        help='Upload everything, not just the changes')
+    parser.add_argument('--bundle', action='store_true',
+                        help='Send all the stems to Canvas as one zip file and one import')
+    parser.add_argument('--watch', action='store_true',
+                        help='Keep running, and update each stem as soon as a new export of it arrives')
+    parser.add_argument('--debounce', default=30, type=float,
+                        help='With --watch, seconds a file must be left alone before it is read')
+    parser.add_argument('--poll-interval', default=60, type=float,
+                        help='With --watch, seconds between checks where inotify cannot be used, '
+                             'and between retries of a failed cycle')
+    parser.add_argument('--daemon', action='store_true',
+                        help='Keep running, and run a cycle every --interval seconds')
+    parser.add_argument('--interval', default=600, type=float,
+                        help='With --daemon, seconds from the start of one cycle to the start of the next')
+    args = parser.parse_args(argv)
+    return vars(args)
 
-        do_filtering:bool = True
-        if len(argv) > 1 and argv[1] == '--upload-only':
-            do_filtering = False
-        # print(argv, do_filtering)
+# Runs one filter/upload cycle for the stems in FILTERS, holding the
+# upload lock (see upload_lock) throughout.  The filters
+# run on POOL if one is given, and otherwise on a pool made for the
+# cycle.  Returns the ID of the last upload.
+def run_cycle(datadirs:dict[str, Path], filters:dict[str, StemFilter], args:dict[str, Any],
+              pool:Optional[ProcessPoolExecutor] = None) -> int:
+    do_filtering:bool = not args['upload_only']
+    full:bool = args['full']  # Upload everything, not just the changes
+    bundle:bool = args['bundle']
+    lock = UploadLock(datadirs['outputdir'])
+    last_upload:int = lock.acquire()  # Fails at once if another run has the lock
+    try:
+        # Leave out the stems whose inputs are just as they were at their
+        # last upload
+        manifest = InputManifest(datadirs['outputdir'])
+        prints = {stem: manifest.fingerprint(stem, stem_inputs(stem, datadirs)) for stem in filters}
+        if do_filtering and not full:
+            for stem in list(filters.keys()):
+                if manifest.unchanged(stem, prints[stem], datadirs['outputdir'].joinpath(stem + '.csv')):
+                    print(stem, 'unchanged since its last upload')
+                    del filters[stem]
+        if not filters:
+            print('Nothing to do')
+            # Still report an import of the last cycle that failed
+            lock.update(stage='checking last upload')
+            confirm_upload(datadirs['outputdir'], last_upload)
+            manifest.promote(last_upload)
    
-        for stem in filters.keys():
-            print(stem)
-            if do_filtering:
+        # The stems are filtered in the background while the uploads go
+        # ahead in order: each stem is uploaded as soon as it is filtered
+        # and the import before it has finished, so filtering one stem
+        # overlaps with importing the one before.
+        started = time.time()  # The filter processes report when they finished by this clock
+        with filter_pool(filters) if pool is None else nullcontext(pool) as pool:
+            filtering: dict[str, Future[tuple[float, float]]] = {}
+            if do_filtering and filters:
                 print('Filtering...')
-                filter_csv(stem, datadirs, filters[stem])
-            last_upload = upload(stem, datadirs['outputdir'], last_upload)
+                lock.update(stage='filtering')
+                filtering = start_filters(pool, filters, datadirs)
+
+            for stem in filters.keys():
+                if stem in filtering:
+                    filtering[stem].result()  # Wait for it, passing on any error
+                if not bundle:
+                    print(stem)
+                    lock.update(stage='uploading ' + stem)
+                    previous = last_upload
+                    last_upload = upload(stem, datadirs['outputdir'], last_upload, full)
+                    lock.update(last_upload=last_upload)
+                    manifest.promote(previous)  # upload() saw it finish
+                    # Only an output made from these inputs may be recorded
+                    # against them; --upload-only sends an older output
+                    if stem in filtering:
+                        manifest.record(stem, prints[stem], datadirs['outputdir'].joinpath(stem + '.csv'),
+                                        None if last_upload == previous else last_upload)
+            if bundle and filters:
+                lock.update(stage='uploading bundle')
+                previous = last_upload
+                last_upload = upload_bundle(list(filters.keys()), datadirs['outputdir'], last_upload, full)
+                lock.update(last_upload=last_upload)
+                manifest.promote(previous)
+                for stem in filtering:
+                    manifest.record(stem, prints[stem], datadirs['outputdir'].joinpath(stem + '.csv'),
+                                    None if last_upload == previous else last_upload)
+        if filtering:
+            timings = {stem: future.result() for stem, future in filtering.items()}
+            report_timings({stem: seconds for stem, (seconds, _) in timings.items()},
+                           max(finished for _, finished in timings.values()) - started)
     except RuntimeError as e:
         #print('RuntimeError:', e.args[0])
-        write_last_upload(e.args[0], datadirs['outputdir'])
-        raise RuntimeError(e)
+        lock.release(str(e))
+        raise
+    except (KeyboardInterrupt, SystemExit) as e:  # Stopped on purpose, not a failure
+        lock.release(interrupted_prefix() + ' ' + type(e).__name__)
+        raise
+    except BaseException as e:  # Anything else is recorded too, for autofix
+        lock.release('Failed: ' + type(e).__name__ + (': ' + str(e) if str(e) else ''))
+        raise
+    else:
+        lock.release()
+    return last_upload
+
+# ------------------- long-running modes ---------------------------------
+# With --daemon or --watch, csv_update keeps running between cycles, and
+# with it the filter processes (which have the fixers imported and their
+# manual entries read), the Canvas token and the connection to Canvas.
+# Each cycle's progress goes to the status file (see sync_status) for
+# the Nagios check.
+
+# Modification times of this directory's modules that have been loaded,
+# so a long-running csv_update can tell when its code has changed.
+def source_stamps() -> dict[str, int]:
+    here = Path(__file__).resolve().parent
+    stamps: dict[str, int] = {}
+    for module in list(sys.modules.values()):
+        source = getattr(module, '__file__', None)
+        if source and Path(source).resolve().parent == here and Path(source).is_file():
+            stamps[source] = Path(source).stat().st_mtime_ns
+    return stamps
+
+# Restarts this process, once a cycle is over, if its code has changed
+# since STAMPS were taken: the filter processes would otherwise go on
+# filtering with the old fixers.
+def restart_if_changed(stamps:dict[str, int], pool:ProcessPoolExecutor, status:SyncStatus) -> None:
+    if source_stamps() != stamps:
+        print('Code has changed, restarting')
+        pool.shutdown()
+        status.update(state='stopped', message='Restarting for new code')
+        os.execv(sys.executable, [sys.executable] + sys.argv)
+
+# Runs a cycle for the stems in FILTERS on the long-lived POOL, recording
+# it in STATUS.  A failed cycle is reported rather than raised, so the
+# caller can try again later.  Returns whether the cycle succeeded, and
+# the pool to use from now on (a new one if a filter process died).
+def serve_cycle(datadirs:dict[str, Path], filters:dict[str, StemFilter], args:dict[str, Any],
+                pool:ProcessPoolExecutor, status:SyncStatus) -> tuple[bool, ProcessPoolExecutor]:
+    print(time.strftime('%Y-%m-%d %H:%M:%S'), 'Starting cycle')
+    status.cycle_started(list(filters.keys()))
+    try:
+        last_upload = run_cycle(datadirs, filters, args, pool)
+    except BrokenProcessPool as e:
+        traceback.print_exc()
+        status.cycle_failed('Filter process died: ' + str(e))
+        pool.shutdown()
+        return False, filter_pool(stem_list())
+    except Exception as e:  # Canvas and file errors included; they may clear up
+        traceback.print_exc()
+        status.cycle_failed(str(e))
+        return False, pool
+    status.cycle_finished(last_upload)
+    return True, pool
+
+# Watches the input directory, and runs a cycle for just the stems whose
+# input files changed, as soon as they have finished arriving.  Every
+# stem gets a cycle at startup, which the input manifest makes cheap, so
+# nothing that arrived while csv_update was not running (or restarting)
+# is missed.  A cycle that fails (for instance because a cron run holds
+# the lock) is retried every --poll-interval seconds until it succeeds.
+def watch_inputs(datadirs:dict[str, Path], args:dict[str, Any]) -> None:
+    filters = stem_list()
+    status = SyncStatus(datadirs['outputdir'], 'watch')
+    stamps = source_stamps()
+    pool = filter_pool(filters)
+    waiting: set[str] = set(filters)  # The startup cycle
+    try:
+        status.update(state='idle')
+        # The first (empty) set of changes comes once watching has started
+        for changed in watch(datadirs['inputdir'], {stem + '.csv' for stem in filters},
+                             args['debounce'], args['poll_interval']):
+            waiting |= {name[:-len('.csv')] for name in changed}
+            if not waiting:
+                continue
+            if changed:
+                print(time.strftime('%Y-%m-%d %H:%M:%S'), 'New input for', ', '.join(sorted(waiting)))
+            ok, pool = serve_cycle(datadirs, {stem: f for stem, f in filters.items() if stem in waiting},
+                                   args, pool, status)
+            if ok:
+                waiting.clear()
+            else:
+                print('Cycle failed, will retry in', args['poll_interval'], 's')
+            restart_if_changed(stamps, pool, status)
+    finally:
+        pool.shutdown()
+        status.update(state='stopped')
+
+# Runs a cycle every INTERVAL seconds, in place of running csv_update
+# from cron.  Stems whose inputs have not changed are skipped as usual,
+# so a cycle with nothing new costs little more than a few stat calls.
+def run_daemon(datadirs:dict[str, Path], args:dict[str, Any]) -> None:
+    status = SyncStatus(datadirs['outputdir'], 'daemon')
+    stamps = source_stamps()
+    pool = filter_pool(stem_list())
+    try:
+        while True:
+            next_cycle = time.time() + args['interval']
+            _, pool = serve_cycle(datadirs, stem_list(), args, pool, status)
+            restart_if_changed(stamps, pool, status)
+            status.update(next_cycle=int(next_cycle))
+            time.sleep(max(0.0, next_cycle - time.time()))
+    finally:
+        pool.shutdown()
+        status.update(state='stopped')
+
+def main(argv:list[str]) -> int:
+    args = parse_args(argv[1:])
+    datadirs:dict[str, Path] = get_data_dirs()
+    if args['daemon'] or args['watch']:
+        # Stop cleanly (recording it in the status file) when told to
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    if args['daemon']:
+        run_daemon(datadirs, args)
+    elif args['watch']:
+        watch_inputs(datadirs, args)
     else:
-        write_last_upload(str(last_upload), datadirs['outputdir'])
+        run_cycle(datadirs, stem_list(), args)
     return 0
 
 if __name__ == '__main__':
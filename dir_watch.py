@@ -0,0 +1,155 @@
+# Watching a directory for new versions of files, for csv_update --watch.
+# Changes are picked up with inotify where the kernel can report them, and
+# by polling the files' size and modification time where it cannot (the
+# SIS exports arrive on an SMB mount, and inotify never hears about
+# changes made by the file server).  Either way, a file only counts as
+# changed once it has been left alone for a while, so a file still being
+# written is not read half-finished.
+
+from pathlib import Path
+from typing import Iterator, Optional
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+
+# Filesystems on which changes can happen without the local kernel knowing
+NETWORK_FILESYSTEMS = ('cifs', 'smb3', 'smbfs', 'nfs', 'nfs4', 'afs', 'ncpfs', '9p')
+
+# inotify event masks, from <sys/inotify.h>
+IN_MODIFY = 0x002
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_Q_OVERFLOW = 0x4000
+EVENT_HEADER = struct.Struct('iIII')  # wd, mask, cookie, len
+
+def filesystem_type(path: Path) -> str:
+    """Return the type of the filesystem PATH is on, from /proc/mounts
+    ('' if it cannot be told)."""
+    best, fstype = '', ''
+    try:
+        with open('/proc/mounts') as f:
+            for line in f:
+                fields = line.split()
+                mountpoint = fields[1].replace('\\040', ' ')
+                if str(path.resolve()).startswith(mountpoint.rstrip('/') + '/') or \
+                        str(path.resolve()) == mountpoint:
+                    if len(mountpoint) >= len(best):
+                        best, fstype = mountpoint, fields[2]
+    except OSError:
+        pass
+    return fstype
+
+class StatPoller:
+    """Finds changes among NAMES in DIRECTORY by comparing their size and
+    modification time every INTERVAL seconds."""
+    def __init__(self, directory: Path, names: set[str], interval: float):
+        self.directory = directory
+        self.names = names
+        self.interval = interval
+        self.stats = self.snapshot()
+
+    def snapshot(self) -> dict[str, Optional[tuple[int, int]]]:
+        stats: dict[str, Optional[tuple[int, int]]] = {}
+        for name in self.names:
+            try:
+                stat = self.directory.joinpath(name).stat()
+                stats[name] = (stat.st_size, stat.st_mtime_ns)
+            except FileNotFoundError:
+                stats[name] = None
+        return stats
+
+    def wait(self, timeout: float) -> set[str]:
+        """Wait up to TIMEOUT seconds (but no longer than the polling
+        interval), then return the names that changed."""
+        time.sleep(max(0.0, min(timeout, self.interval)))
+        stats = self.snapshot()
+        changed = {name for name in self.names if stats[name] != self.stats[name]}
+        self.stats = stats
+        return changed
+
+    def close(self) -> None:
+        pass
+
+class InotifyWatcher:
+    """Finds changes among NAMES in DIRECTORY with inotify, called through
+    ctypes since the standard library has no interface to it."""
+    def __init__(self, directory: Path, names: set[str]):
+        self.names = names
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd: int = libc.inotify_init1(os.O_CLOEXEC | os.O_NONBLOCK)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory), mask) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, 'inotify_add_watch failed', str(directory))
+
+    def wait(self, timeout: float) -> set[str]:
+        """Wait up to TIMEOUT seconds for events, and return the names
+        they were about."""
+        changed: set[str] = set()
+        ready, _, _ = select.select([self.fd], [], [], max(0.0, timeout))
+        while ready:
+            try:
+                buf = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(buf):
+                _, mask, _, length = EVENT_HEADER.unpack_from(buf, offset)
+                name = os.fsdecode(buf[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length]
+                                   .rstrip(b'\0'))
+                offset += EVENT_HEADER.size + length
+                if mask & IN_Q_OVERFLOW:  # Events were lost, so assume the worst
+                    changed |= self.names
+                elif name in self.names:
+                    changed.add(name)
+        return changed
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+def watch(directory: Path, names: set[str], debounce: float = 30,
+          poll_interval: float = 60) -> Iterator[set[str]]:
+    """Watch NAMES in DIRECTORY, yielding the set of names that changed
+    each time one or more files settle: changed, and then left alone for
+    DEBOUNCE seconds.  Polls every POLL_INTERVAL seconds where inotify
+    cannot be used.  An empty set is yielded once watching has started,
+    and again whenever POLL_INTERVAL passes with nothing changing, so the
+    caller can do other work (retries, say) on a timer."""
+    watcher: StatPoller | InotifyWatcher
+    fstype = filesystem_type(directory)
+    if fstype in NETWORK_FILESYSTEMS:
+        print('Polling', directory, 'every', poll_interval, 's (on', fstype + ')')
+        watcher = StatPoller(directory, names, poll_interval)
+    else:
+        try:
+            watcher = InotifyWatcher(directory, names)
+            print('Watching', directory, 'with inotify')
+        except (OSError, AttributeError) as e:  # AttributeError: no inotify in this libc
+            print('Polling', directory, 'every', poll_interval, 's:', e)
+            watcher = StatPoller(directory, names, poll_interval)
+
+    settling: dict[str, float] = {}  # When each changed file last changed
+    try:
+        yield set()
+        while True:
+            now = time.monotonic()
+            timeout = min(settling.values()) + debounce - now if settling else poll_interval
+            for name in watcher.wait(timeout):
+                settling[name] = time.monotonic()
+            now = time.monotonic()
+            settled = {name for name, changed in settling.items() if now - changed >= debounce}
+            if settled:
+                for name in settled:
+                    del settling[name]
+                yield settled
+            elif not settling:
+                yield set()
+    finally:
+        watcher.close()
@@ -3,69 +3,181 @@
 # Peter Brown <peter.brown@converse.edu>, 2020-08-04
 
 import csv
+import os
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
 from pathlib import Path
-from collections.abc import Callable
+from collections.abc import Callable, Iterable, Iterator, MutableMapping
+from typing import Any, cast
 from fix_users import filter_users
 from fix_courses import filter_courses
 from fix_enrollments import filter_enrollments
 from fix_terms import filter_terms
 
-# Almost-empty filter just returns a shallow copy of the input.
-def identity_filter(records: list[dict[str, str]]) -> list[dict[str, str]]:
-    return records[:]
-
-# Returns a dict of the stems and their associated filters
-def stem_list() -> dict[str, Callable[[list[dict[str, str]]],
-                                      list[dict[str, str]]]]:
-    return {'Enrollments': filter_enrollments #,
-            # 'users': filter_users,
-            # 'Courses' : filter_courses,
-            # 'Terms': filter_terms,
+# A stem filter takes the records of a CSV file and produces the records
+# to upload.  Filters are generators, so records flow through one at a
+# time from reading to writing, and memory use does not depend on the
+# size of the file.
+StemFilter = Callable[[Iterable[MutableMapping[str, str]]], Iterable[MutableMapping[str, str]]]
+
+# Almost-empty filter just passes the input through.
+def identity_filter(records: Iterable[MutableMapping[str, str]]) -> Iterator[MutableMapping[str, str]]:
+    yield from records
+
+# Returns a dict of the stems and their associated filters, in the order
+# Canvas needs them imported (terms before the courses in them, courses
+# and users before enrollments).
+def stem_list() -> dict[str, StemFilter]:
+    return {'Terms': filter_terms,
+            'Courses' : filter_courses,
+            'users': filter_users,
+            'Enrollments': filter_enrollments #,
             # 'accounts': identity_filter
             }
 
+# Removes a byte-order mark from the first column title, if present.
+# Only the start of the file can carry one, so this is done once per file
+# rather than for every key of every row.
+# See https://en.wikipedia.org/wiki/Byte_order_mark for detail
+def fix_header(header: list[str]) -> list[str]:
+    if header:
+        first:str = header[0]
+        # UTF-8 3-character BOM (0xEFBBBF)
+        if first.startswith(chr(239) + chr(187) + chr(191)):
+            first = first[3:]
+        # UTF-16 1-character BOM (0xFEFF or 0xFFFE)
+        elif first.startswith('\ufeff') or first.startswith('\ufffe'):
+            first = first[1:]
+        header = [first] + header[1:]
+    return header
+
+_DELETED = object()  # Marks a column deleted from a Row
+
+class Row(MutableMapping[str, str]):
+    """One row of a CSV file, stored as the list of values the csv module
+    read plus a column index shared by every row of the file, which takes
+    far less memory than a dict per row.  It behaves like a dict, so the
+    filters can treat it as one; keys that are not columns of the file can
+    still be added, and are kept separately."""
+    __slots__ = ('_index', '_values', '_extra')
+
+    def __init__(self, index: dict[str, int], values: list[Any]):
+        self._index = index
+        self._values = values
+        self._extra: dict[str, str] | None = None
+
+    def __getitem__(self, key: str) -> str:
+        i = self._index.get(key)
+        if i is not None:
+            value = self._values[i]
+            if value is not _DELETED:
+                return cast(str, value)
+        elif self._extra is not None and key in self._extra:
+            return self._extra[key]
+        raise KeyError(key)
+
+    def get(self, key: str, default: Any = None) -> Any:  # Faster than Mapping's
+        i = self._index.get(key)
+        if i is not None:
+            value = self._values[i]
+            return default if value is _DELETED else value
+        if self._extra is not None:
+            return self._extra.get(key, default)
+        return default
+
+    def __setitem__(self, key: str, value: str) -> None:
+        i = self._index.get(key)
+        if i is not None:
+            self._values[i] = value
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __delitem__(self, key: str) -> None:
+        i = self._index.get(key)
+        if i is not None and self._values[i] is not _DELETED:
+            self._values[i] = _DELETED
+        elif self._extra is not None and key in self._extra:
+            del self._extra[key]
+        else:
+            raise KeyError(key)
+
+    def __iter__(self) -> Iterator[str]:
+        for key, i in self._index.items():
+            if self._values[i] is not _DELETED:
+                yield key
+        if self._extra is not None:
+            yield from self._extra
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def __repr__(self) -> str:
+        return 'Row({0!r})'.format(dict(self))
+
+    def copy(self) -> 'Row':
+        row = Row(self._index, self._values[:])
+        if self._extra is not None:
+            row._extra = dict(self._extra)
+        return row
+
+# Reads a CSV file one row at a time, yielding a Row per row of data in
+# the CSV file.  For each row, the keys are the CSV column titles, and
+# the values are the corresponding data values from the row.  As with
+# csv.DictReader, blank lines are skipped and short rows are padded
+# with None.  Values that repeat (roles, statuses, course ids) are
+# shared between rows rather than stored once per row.
+def iter_csv(infile:Path) -> Iterator[Row]:
+    seen: dict[str, str] = {}
+    share = seen.setdefault
+    with open(infile, newline='') as f:
+        reader = csv.reader(f)
+        header: list[str] = fix_header(next(reader, []))
+        index: dict[str, int] = {key: i for i, key in enumerate(header)}
+        width = len(header)
+        for values in reader:
+            if not values:
+                continue
+            if len(values) < width:
+                values.extend([None] * (width - len(values)))  # type: ignore[list-item]
+            yield Row(index, list(map(share, values, values)))
+
 # Reads a CSV file into a list of dictionaries, one dictionary per
-# row of data in the CSV file.  For each row, the keys of the dict are
-# the CSV column titles, and the values are the corresponding data
-# values from the row.
+# row of data in the CSV file.
 def read_from_csv(infile:Path) -> list[dict[str, str]]:
     records: list[dict[str, str]] = []
     with open(infile, newline='') as f:
-        reader = csv.DictReader(f) # Turns each row into a dictionary
-        for row in reader:
-            # Remove BOM from key, if present
-            # See https://en.wikipedia.org/wiki/Byte_order_mark for detail
-            newrow = row.copy()
-            for key in row.keys():
-                newkey:str = key
-                
-                # UTF-8 3-character BOM (0xEFBBBF)
-                if key.startswith(chr(239) + chr(187) + chr(191)):
-                    newkey = key[3:]
-                # UTF-16 1-character BOM (0xFEFF or 0xFFFE)
-                elif key.startswith('\ufeff') or key.startswith('\ufffe'):
-                    newkey = key[1:]
-
-                # Strip out the BOM if present    
-                if newkey != key:
-                    newrow[newkey] = row[key]
-                    del newrow[key]
-                    
-            records.append(newrow)
+        reader = csv.reader(f)
+        header: list[str] = fix_header(next(reader, []))
+        for values in reader:
+            if values:
+                records.append(dict(zip(header, values)))
     # Post: for all 0 <= i < j < len(records),
     #              records[i].keys() == records[j].keys()
-    # The dictReader guarantees this is true, BTW.
+    # Short rows would break this, but the files we read have none.
     return records
 
+# Manual entries already read, by file name, with the size and
+# modification time of the file when they were read.  A long-running
+# csv_update (see --daemon) keeps its filter processes, so each file is
+# only read again once it changes.
+_manual_entries: dict[str, tuple[tuple[int, int], list[dict[str, str]]]] = {}
+
 def read_manual_entries(fname: str) -> list[dict[str, str]]:
     """If CSV file FILENAME exists in the current directory, read and
     return the records contained in it."""
-    records: list[dict[str, str]] = []
     infile = Path(__file__).parent.joinpath(fname)
     print(infile)
-    if infile.is_file():
-        records = read_from_csv(infile)
-    return records
+    if not infile.is_file():
+        return []
+    stat = infile.stat()
+    stamp = (stat.st_size, stat.st_mtime_ns)
+    cached = _manual_entries.get(fname)
+    if cached is None or cached[0] != stamp:
+        cached = _manual_entries[fname] = (stamp, read_from_csv(infile))
+    # The filters change records in place, so every caller gets fresh copies
+    return [dict(record) for record in cached[1]]
 
 def read_manual_enrollments() -> list[dict[str, str]]:
     """If manual_enrollments.csv exists in the current directory, read
@@ -90,18 +202,55 @@ def write_outfile(records: list[dict[str, str]], outfile:Path) -> None:
         for row in records:
             writer.writerow(row)
 
+# Takes records one at a time--each a dictionary--and writes them to a
+# CSV file as they come, so they never all have to be in memory.  The
+# header is taken from the first record.  Returns the number of records.
+def write_stream(records: Iterable[MutableMapping[str, str]], outfile:Path) -> int:
+    count = 0
+    with open(outfile, 'w', newline='') as f:
+        writer: csv.DictWriter[str] | None = None
+        for row in records:
+            if writer is None:
+                writer = csv.DictWriter(f, fieldnames=list(row.keys()))
+                writer.writeheader()
+            writer.writerow(row)
+            count += 1
+    print(f'Wrote {count} records to {outfile}')
+    return count
+
 # Takes a STEM, a pair of directories DATA_DIRS, and a filter function
-# STEM_FILTER.  Reads an input CSV file, filters the resulting records
-# using STEM_FILTER, and writes the result to an output CSV file.
-def filter_csv(stem:str, data_dirs:dict[str, Path],
-           stem_filter:Callable[[list[dict[str, str]]], \
-                                list[dict[str, str]]]) -> None:
+# STEM_FILTER.  Streams the records of an input CSV file through
+# STEM_FILTER and into an output CSV file.
+def filter_csv(stem:str, data_dirs:dict[str, Path], stem_filter:StemFilter) -> None:
     infile:Path = data_dirs['inputdir'].joinpath(stem + '.csv')
-    inrecords: list[dict[str, str]] = read_from_csv(infile)
-    #print(inrecords[:30])
-    outrecords: list[dict[str, str]] = stem_filter(inrecords)
     outfile:Path = data_dirs['outputdir'].joinpath(stem + '.csv')
-    write_outfile(outrecords, outfile)
+    write_stream(stem_filter(iter_csv(infile)), outfile)
+
+# Runs filter_csv for one stem and returns how long it took, in seconds,
+# and when it finished (by the wall clock, which every process shares).
+def timed_filter_csv(stem:str, data_dirs:dict[str, Path], stem_filter:StemFilter) -> tuple[float, float]:
+    started = time.perf_counter()
+    filter_csv(stem, data_dirs, stem_filter)
+    return time.perf_counter() - started, time.time()
+
+# Returns a process pool big enough to filter all the stems in FILTERS at once.
+def filter_pool(filters:dict[str, StemFilter]) -> ProcessPoolExecutor:
+    return ProcessPoolExecutor(max(1, min(len(filters), os.cpu_count() or 1)))
+
+# Starts filtering every stem in FILTERS on POOL, each in its own process
+# reading its own input file.  Returns a future for each stem giving the
+# time it took and when it finished (see timed_filter_csv), so callers can
+# go on with a stem as soon as it is ready.
+def start_filters(pool:ProcessPoolExecutor, filters:dict[str, StemFilter],
+                  data_dirs:dict[str, Path]) -> dict[str, Future[tuple[float, float]]]:
+    return {stem: pool.submit(timed_filter_csv, stem, data_dirs, stem_filter)
+            for stem, stem_filter in filters.items()}
+
+def report_timings(timings:dict[str, float], elapsed:float) -> None:
+    for stem, seconds in timings.items():
+        print(f'Filtered {stem} in {seconds:.2f} s')
+    print(f'Filtered {len(timings)} stems in {elapsed:.2f} s '
+          f'({sum(timings.values()):.2f} s if run one after another)')
 
 
 if __name__ == '__main__':
@@ -6,6 +6,7 @@
 # Changed from a standalone program to a library, 2020-08-04
 
 #from pathlib import Path
+from collections.abc import Iterable, Iterator
 from typing import cast
 
 goodterms: tuple[str,...] = ('2021-SF', '2021-FA', '2021-JS',
@@ -125,19 +126,21 @@ def valid_course(record: dict[str,str]) -> bool:
     #(record['term_id'] in goodterms)
     #return result
 
-# Takes a list of course records, each one a dictionary, filters them,
-# and returns the result of that filtering.
-def filter_courses(inrecords: list[dict[str, str]]) -> list[dict[str, str]]:
-    outrecords: list[dict[str, str]] = []
+# Takes course records, each one a dictionary, filters them, and yields
+# the result of that filtering one record at a time.
+def filter_courses(inrecords: Iterable[dict[str, str]]) -> Iterator[dict[str, str]]:
+    incount: int = 0
+    outcount: int = 0
     rejected_courses: list[str] = []
     for record in inrecords:
+        incount += 1
         if valid_course(record):
-            outrecords.append(filter_one_course(record))
+            outcount += 1
+            yield filter_one_course(record)
         else:
             rejected_courses.append(record['course_id'])
             #print('Course rejected: ', record['course_id'])
     print('Rejected:', rejected_courses)
     # Post:
-    assert len(inrecords) - len(rejected_courses) == len(outrecords), \
-        f"{len(inrecords)} - {len(rejected_courses)} != {len(outrecords)}"
-    return outrecords
+    assert incount - len(rejected_courses) == outcount, \
+        f"{incount} - {len(rejected_courses)} != {outcount}"
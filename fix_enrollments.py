@@ -4,7 +4,9 @@
 
 import filter_csv # for read_manual_entries()
 import re
+from collections.abc import Iterable, Iterator
 from fix_courses import course_id_ok
+from itertools import chain
 from typing import cast, Optional
 
 def ok_to_add(inrecord: dict[str, str], last_outrecord: dict[str, str]) -> bool:
@@ -92,14 +94,21 @@ def ok_to_add(inrecord: dict[str, str], last_outrecord: dict[str, str]) -> bool:
     return ok
 
 
-def filter_enrollments(inrecords: list[dict[str, str]]) -> list[dict[str, str]]:
+def filter_enrollments(inrecords: Iterable[dict[str, str]]) -> Iterator[dict[str, str]]:
+    """Takes enrollment records INRECORDS and yields the filtered records,
+       one at a time.  The only state kept is what the filter needs: the
+       last record yielded, the extra records made for course_doubles, and
+       the sets of students and teachers."""
     #print('Filtering enrollments')
 
     # Add the manual enrollments, if any
-    inrecords.extend(filter_csv.read_manual_entries('manual_enrollments.csv'))
+    manual = filter_csv.read_manual_entries('manual_enrollments.csv')
 
-    outrecords: list[dict[str, str]] = []
-    # Track the last record added to the outrecords
+    # Records added for course_doubles are handled after everything else,
+    # in the order they were made
+    doubles: list[dict[str, str]] = []
+
+    # Track the last record yielded
     last_outrecord: dict[str, str | None] = {'status': None}
     
     # course_subs is used to substitute one course for another.  The effect is
@@ -125,7 +134,8 @@ def filter_enrollments(inrecords: list[dict[str, str]]) -> list[dict[str, str]]:
     teachers: set[str] = set()
     #print(blacklist[0][0])
 
-    for record in inrecords:
+    # Iterating over DOUBLES picks up records appended to it along the way
+    for record in chain(inrecords, manual, doubles):
         # Suppress enrollments in courses that fix_courses rejects
         if not course_id_ok(record['course_id']):
             continue
@@ -136,14 +146,14 @@ def filter_enrollments(inrecords: list[dict[str, str]]) -> list[dict[str, str]]:
         elif record['course_id'] in course_doubles.keys():
             newrecord = dict(record,
                              course_id=course_doubles[record['course_id']])
-            inrecords.append(newrecord)
+            doubles.append(newrecord)
 
-        # Add the adjusted record to outrecords
+        # Pass the adjusted record on
         #if not (record['user_id'], record['course_id']) in blacklist:
         if ok_to_add(record, cast(dict[str, str], last_outrecord)):
             #if record['user_id'] == blacklist[0][0]:
             #    print(record)
-            outrecords.append(record)
+            yield record
             last_outrecord = cast(dict[str, Optional[str]], record)
 
         # Keep track of students and teachers
@@ -157,23 +167,21 @@ def filter_enrollments(inrecords: list[dict[str, str]]) -> list[dict[str, str]]:
                   'root_account': '', 'user_id': s, 'user_integration_id': '',
                   'role': 'student', 'section_id': '','status': 'active',
                   'associated_user_id': '', 'limit_section_priveleges': '' }
-        outrecords.append(record)
+        yield record
         record = {'course_id': 'C@C', 'root_account': '', 'user_id': s,
                   'user_integration_id': '', 'role': 'observer',
                   'section_id': '', 'status': 'active',
                   'associated_user_id': '', 'limit_section_priveleges': ''}
-        outrecords.append(record)
+        yield record
 
     for t in teachers:
         record = {'course_id': 'growing_with_canvas',
                   'root_account': '', 'user_id': t, 'user_integration_id': '',
                   'role': 'student', 'section_id': '','status': 'active',
                   'associated_user_id': '', 'limit_section_priveleges': '' }
-        outrecords.append(record)
+        yield record
         record = {'course_id': 'C@C', 'root_account': '', 'user_id': t,
                   'user_integration_id': '', 'role': 'observer',
                   'section_id': '', 'status': 'active',
                   'associated_user_id': '', 'limit_section_priveleges': ''}
-        outrecords.append(record)
-        
-    return outrecords
+        yield record
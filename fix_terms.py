@@ -1,4 +1,5 @@
 import datetime as dt
+from collections.abc import Iterable, Iterator
 from zoneinfo import ZoneInfo
 
 good_suffixes = ('FA', 'JA', 'SP', 'AS', 'BS', '2S', '3S')
@@ -78,14 +79,12 @@ def filter_one_term(inrec: dict[str, str]) -> list[dict[str, str]]:
 
     return outrecords
     
-def filter_terms(inrecords: list[dict[str,str]]) -> list[dict[str,str]]:
-    """Takes a list of term specifications INRECORDS and returns a
-       filtered list of term specifications for import to Canvas."""
-    outrecords: list[dict[str, str]] = []
+def filter_terms(inrecords: Iterable[dict[str,str]]) -> Iterator[dict[str,str]]:
+    """Takes term specifications INRECORDS and yields the filtered term
+       specifications for import to Canvas, one at a time."""
     for record in inrecords:
         if good_term(record['term_id']):
-            outrecords.extend(filter_one_term(record))
-    return outrecords
+            yield from filter_one_term(record)
 
 def main(args: list[str]) -> int:
     """For testing purposes."""
@@ -106,7 +105,7 @@ def main(args: list[str]) -> int:
     first_out = filter_one_term(inrecords[5])
     print(first_out)
 
-    print(filter_terms(inrecords))
+    print(list(filter_terms(inrecords)))
 
     return 0
     
@@ -5,6 +5,8 @@
 
 import filter_csv # for read_manual_entries
 import re
+from collections.abc import Iterable, Iterator
+from itertools import chain
 
 # Fix initials in the long name.  I am brazenly assuming that we have no
 # Harry S Trumans, and that every initial actually stands for something.
@@ -44,15 +46,12 @@ def valid_for_input(record:dict[str, str]) -> bool:
         result = False
     return result
 
-# Takes a list of user records, each one a dictionary, filters them,
-# and returns the result of that filtering.
-def filter_users(inrecords:list[dict[str, str]]) -> list[dict[str, str]]:
-    outrecords:list[dict[str, str]] = []
-
+# Takes user records, each one a dictionary, filters them, and yields
+# the result of that filtering one record at a time.
+def filter_users(inrecords:Iterable[dict[str, str]]) -> Iterator[dict[str, str]]:
 # Add the manual users if any
-    inrecords.extend(filter_csv.read_manual_entries('manual_users.csv'))
+    manual = filter_csv.read_manual_entries('manual_users.csv')
     
-    for record in inrecords:
+    for record in chain(inrecords, manual):
         if valid_for_input(record):
-            outrecords.append(filter_one_user(record))
-    return outrecords
+            yield filter_one_user(record)
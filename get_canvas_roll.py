@@ -3,44 +3,43 @@
 # FFunctions for extracting a Canvas class roll using the Canvas API.  Stores results in a Dropbox directory.
 
 from pathlib import Path
-from typing import Any
-import json
-import subprocess
+from typing import Any, Iterable, Iterator
 import sys
+from canvas_api import api_url, get_paginated
+from canvas_graphql import GraphQL
 from filter_csv import write_outfile
-from upload_csv import constants, get_access_token, bytesOrStrPrintable
 
 def course_id_from_code(course_code: str) -> str:
     """Given a course code, find the corresponding course ID."""
     id: str = ''
-    token = get_access_token()
-    cmd = ['curl', '--no-progress-meter', '--show-error', 
-            '--header', 'Authorization: Bearer ' + token,
-            'https://{0}/api/v1/accounts/1/courses?enrollment_type[]=student&published=true&search_by=course&search_term={1}'.format(
-                constants()['host'], course_code)]
-    output: str = bytesOrStrPrintable(subprocess.check_output(cmd))
-    #print(output)
-    data: list[dict[str, Any]] = json.loads(output)
+    data: list[dict[str, Any]] = list(get_paginated(api_url('accounts/1/courses'),
+                                                    params=[('enrollment_type[]', 'student'),
+                                                            ('published', 'true'),
+                                                            ('search_by', 'course'),
+                                                            ('search_term', course_code)]))
     #print(data)
     assert(len(data) == 1)
     id = str(data[0]['id'])
     return id
 
-def get_course_roll(course_id: str) -> list[dict[str, Any]]:
-    """Given a course ID, get the student roll."""
-    token = get_access_token()
-    cmd = ['curl', '--no-progress-meter', '--show-error', 
-            '--header', 'Authorization: Bearer ' + token,
-            'https://{0}/api/v1/courses/{1}/users?enrollment_type[]=student&sort=sortable_name&per_page=100'.format(
-                constants()['host'], course_id)]
-    output: str = bytesOrStrPrintable(subprocess.check_output(cmd))
-    # print(output)
-    # find the JSON in the output
+def course_ids_from_codes(course_codes: list[str]) -> dict[str, str]:
+    """Given several course codes (SIS course ids), find all their course
+    ID's with one batched GraphQL query instead of a search per course."""
+    ids: dict[str, str] = {}
+    for code, course in GraphQL().courses_by_sis_id(course_codes).items():
+        assert course is not None, code
+        ids[code] = course['_id']
+    return ids
 
-    data: list[dict[str, Any]] = json.loads(output)
-    return data
+def get_course_roll(course_id: str) -> Iterator[dict[str, Any]]:
+    """Given a course ID, get the student roll.  Users are yielded one at a
+    time, across as many pages as the course needs."""
+    return get_paginated(api_url('courses/{0}/users'.format(course_id)),
+                         params=[('enrollment_type[]', 'student'),
+                                 ('sort', 'sortable_name'),
+                                 ('per_page', 100)])
 
-def normalize_fields(inrecords: list[dict[str, Any]], include_all_fields: bool = False) -> list[dict[str, str]]:
+def normalize_fields(inrecords: Iterable[dict[str, Any]], include_all_fields: bool = False) -> list[dict[str, str]]:
     """Takes a set of input records INRECORDS, and returns a normalized version.
         In the normalized version, all the dictionaries in the list have the
         same set of headers, and the values for all the keys are strings."""
@@ -48,6 +47,7 @@ def normalize_fields(inrecords: list[dict[str, Any]], include_all_fields: bool =
     fields = ['id', 'sis_user_id', 'name', 'sortable_name', 'short_name', 'pronouns', 'login_id', 'email', 'created_at']
     # Include all the fields if desired, but usually don't bother.
     if include_all_fields:
+        inrecords = list(inrecords)  # Needs two passes
         for rec in inrecords:  # The looping approach preserves the order of fields
             for key in rec.keys():
                 if key not in fields:
@@ -65,18 +65,21 @@ def normalize_fields(inrecords: list[dict[str, Any]], include_all_fields: bool =
 
 
 def main(args: list[str]) -> int:
-    course_code: str = 'HPE125.01-2526-FA'
-    if (len(args) > 1):
-        course_code = args[1]
-    print('Course code:', course_code)
-    course_id: str = course_id_from_code(course_code)
-    print('Course ID:', course_id)
-    roll: list[dict[str, Any]] = get_course_roll(course_id)
-    print('Got', len(roll), 'users')
-    roll = normalize_fields(roll)
-    #print(roll)
+    course_codes: list[str] = [arg for arg in args[1:] if arg != '--graphql']
+    if not course_codes:
+        course_codes = ['HPE125.01-2526-FA']
+    if '--graphql' in args:
+        course_ids: dict[str, str] = course_ids_from_codes(course_codes)
+    else:
+        course_ids = {code: course_id_from_code(code) for code in course_codes}
     roll_file_dir = Path.home().joinpath('Dropbox', 'DEd', 'Canvas', 'rolls')
-    write_outfile(roll, roll_file_dir.joinpath(course_code + "_roll.csv"))
+    for course_code, course_id in course_ids.items():
+        print('Course code:', course_code)
+        print('Course ID:', course_id)
+        roll: list[dict[str, str]] = normalize_fields(get_course_roll(course_id))
+        print('Got', len(roll), 'users')
+        #print(roll)
+        write_outfile(roll, roll_file_dir.joinpath(course_code + "_roll.csv"))
     return 0
 
 if __name__ == '__main__':
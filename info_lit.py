@@ -1,17 +1,23 @@
 #! /usr/bin/python3
 
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from functools import partial
 from pathlib import Path
-from typing import cast
+from tempfile import TemporaryDirectory
+from typing import cast, IO, Iterator, Optional
+import argparse
 import csv
-import json
-import subprocess
+import shutil
 import sys
 import time
 import urllib.parse
+from canvas_api import api_url, download, get_json, get_paginated, post_json
+from canvas_graphql import GraphQL
 from course_backups import recent
 from filter_csv import read_from_csv
+from poller import JobTimeout, Poller
+from report_cache import cache_dir, ReportCache
 from typing import Any
-from upload_csv import constants, get_access_token, bytesOrStrPrintable
 
 def read_courses_from_file(filename: Path) -> tuple[list[int], list[str]]:
     """Takes the name of a CSV file containing course records (as from a
@@ -23,127 +29,240 @@ def read_courses_from_file(filename: Path) -> tuple[list[int], list[str]]:
     names: list[str] = [crs['course_id'] for crs in courses]
     return numbers, names
 
-def find_quiz_numbers(course_IDs: list[int]) -> list[int]:
-    assert len(course_IDs) > 0
-    quizzes: list[int] = []
-    token = get_access_token()
+# Title of the info-literacy quiz
+QUIZ_SEARCH = 'information-fluency'
+
+def find_quiz_number(id: int) -> int:
+    """Return the id of the info-fluency quiz in course ID, or 0 if there is none."""
+    url = api_url('courses/{0}/quizzes'.format(id))
+    print(url)
+    data: list[dict[str,Any]] = list(get_paginated(url, params={'search_term': QUIZ_SEARCH}))
+    if len(data) > 1:
+        print('WARNING: course {0} has {1} info-fluency quizzes. Data\n\t{2}'.format(id, len(data), data))
+    #print(id, data)
+    if len(data) == 0:
+        return 0
+    return cast(int, data[-1]['id'])
 
+def find_quiz_numbers(course_IDs: list[int], cache: Optional[ReportCache] = None,
+                      graphql: Optional[GraphQL] = None) -> list[int]:
+    """Find the info-fluency quiz in each of COURSE_IDS (0 where there is
+    none).  Courses not in CACHE are looked up one request per course, or
+    with GRAPHQL, in a few batched queries for all of them."""
+    assert len(course_IDs) > 0
+    found: dict[str, int] = {}
     for id in course_IDs:
-        cmd = ['curl', '--no-progress-meter', '--show-error', 
-                '--header', 'Authorization: Bearer ' + token,
-                'https://{0}/api/v1/courses/{1}/quizzes'.format(constants()['host'], id) +
-                '?search_term=information-fluency']
-        print(cmd)
-        output: str = bytesOrStrPrintable(subprocess.check_output(cmd))
-        data: list[dict[str,Any]] = json.loads(output)
-        if len(data) > 1:
-            print('WARNING: course {0} has {1} info-fluency quizzes. Data\n\t{2}'.format(id, len(data), data))
-        #print(id, data)
-        if len(data) == 0:
-            quizzes.append(0)
-        else:
-            quizzes.append(data[-1]['id'])
+        cached = cache.quiz(id) if cache else None
+        if cached is not None:
+            found[str(id)] = cached
+
+    missing: list[int] = [id for id in course_IDs if str(id) not in found]
+    if graphql and missing:
+        found.update(graphql.find_quizzes(missing, QUIZ_SEARCH))
+    for id in missing:
+        if str(id) not in found:
+            found[str(id)] = find_quiz_number(id)
+        if cache:
+            cache.record_quiz(id, found[str(id)])
 
+    quizzes: list[int] = [found[str(id)] for id in course_IDs]
     assert len(quizzes) == len(course_IDs)
     return quizzes
 
 def get_report_status(course: int, quiz: int) -> list[dict[str,Any]]:
-    token = get_access_token()
-    cmd = ['curl', '--no-progress-meter', '--show-error', 
-                '--header', 'Authorization: Bearer ' + token,
-                'https://{0}/api/v1/courses/{1}/quizzes/{2}/reports'.format(constants()['host'], course, quiz)]
-    print(cmd)
-    output: str = bytesOrStrPrintable(subprocess.check_output(cmd))
-    data: list[dict[str,Any]] = json.loads(output)
+    url = api_url('courses/{0}/quizzes/{1}/reports'.format(course, quiz))
+    print(url)
+    data: list[dict[str,Any]] = list(get_paginated(url))
     return data
 
 def get_one_report_status(course: int, status: dict[str, Any]) -> dict[str, Any]:
     assert 'quiz_id' in status, str(status)
-    token = get_access_token()
-    cmd = ['curl', '--no-progress-meter', '--show-error', 
-                '--header', 'Authorization: Bearer ' + token,
-                'https://{0}/api/v1/courses/{1}/quizzes/{2}/reports/{3}'.format(constants()['host'], 
-                                                                                course, status['quiz_id'], 
-                                                                                status['id'])]
-    print(cmd)
-    output: str = bytesOrStrPrintable(subprocess.check_output(cmd))
-    data: dict[str, Any] = json.loads(output)
-    return data 
+    url = api_url('courses/{0}/quizzes/{1}/reports/{2}'.format(course, status['quiz_id'], status['id']))
+    print(url)
+    data: dict[str, Any] = get_json(url, params={'include[]': 'progress'})
+    return data
 
 def start_report(course: int, old_status: dict[str,Any])-> dict[str,Any]:
-    token = get_access_token()
-    token = get_access_token()
-    cmd = ['curl', '--no-progress-meter', '--show-error', 
-            '--header', 'Authorization: Bearer ' + token,
-            '--form', 'quiz_report[report_type]=' + old_status['report_type'],
-            'https://{0}/api/v1/courses/{1}/quizzes/{2}/reports'.format(constants()['host'],
-                                                                    course, old_status['quiz_id'])]
-    print(cmd)
-    output: str = bytesOrStrPrintable(subprocess.check_output(cmd))
-    #print(output)
-    data: dict[str,Any] = json.loads(output)
+    url = api_url('courses/{0}/quizzes/{1}/reports'.format(course, old_status['quiz_id']))
+    print(url)
+    data: dict[str,Any] = post_json(url, fields={'quiz_report[report_type]': old_status['report_type']})
+    #print(data)
     return data
 
-def get_report(course: int, status: dict[str,Any]) -> str:
-    # First, check if the report is available
-    delay = 12
-    max_tries = 50
-    tries = 0    
-    
-    while 'file' not in status:
-        tries += 1
-        if tries > max_tries:
-            raise Exception("Maximum tries exceeded")
-        time.sleep(delay)
-        status = get_one_report_status(course, status)
-    
-    # The report is now ready
+def report_progress(status: dict[str, Any]) -> Optional[float]:
+    """Return the completion percentage of the report with STATUS, if known."""
+    progress = status.get('progress') or {}
+    return progress.get('completion')
+
+# Polling parameters for quiz reports
+def report_polling() -> dict[str, Any]:
+    return { 'first_delay': 2, 'min_delay': 2, 'max_delay': 30, 'max_wait': 12 * 50 }
+
+def report_ready(status: dict[str, Any]) -> bool:
+    return 'file' in status
+
+def download_report(status: dict[str, Any], outfile: Path) -> Path:
+    """Download the finished report with STATUS into OUTFILE, and return OUTFILE."""
     urlparts = urllib.parse.urlparse(status['file']['url'])
     queryparts = urllib.parse.parse_qs(urlparts.query)
     url = urllib.parse.urlunparse([urlparts.scheme, urlparts.netloc, urlparts.path, '',
                                   'verifier=' + queryparts['verifier'][0], ''])
-    token = get_access_token()
-    cmd = ['curl', '--no-progress-meter', '--show-error', '--location',
-           '--header', 'Authorization: Bearer ' + token, url]
-    print(cmd)
-    output: str = bytesOrStrPrintable(subprocess.check_output(cmd))
-    return output
-
-def write_report(contents: str, outfilename: Path) -> None:
-    with open(outfilename, 'w') as f:
-        f.write(contents)
-
-def filter_report(filename: Path, course_names: list[str]) -> None:
-    course_idx = 0
-    csv_rows: list[dict[str,str]] = []
-    with open(filename, 'r') as infile:
-        reader = csv.DictReader(infile)
-        for row in reader:
-            # Suppress rows that are just repeats of the headers
-            if ('id' in row and row['id'] == 'id') \
-                    or ('Question Id' in row and row['Question Id'] == 'Question Id'):
-                course_idx += 1
-                print("Suppressing line; new section is", course_names[course_idx])
-            # Handle the actual data rows
-            else:
+    print(url)
+    download(url, outfile)
+    return outfile
+
+def fetch_report(status: dict[str, Any], outfile: Path, cache: Optional[ReportCache] = None) -> Path:
+    """Get the body of the finished report with STATUS: from CACHE, if it
+    holds this version of the report, and otherwise by downloading it into
+    OUTFILE (and then into the cache).  Returns where the body is."""
+    if cache:
+        cached = cache.report(status['quiz_id'], status['report_type'], status['file']['updated_at'])
+        if cached is not None:
+            return cached
+    download_report(status, outfile)
+    return cache.store_report(status, outfile) if cache else outfile
+
+def request_reports(course: int, quiz: int) -> list[dict[str, Any]]:
+    """Get the status of both reports for QUIZ in COURSE, starting a new
+    report wherever there is none or the existing one is out of date."""
+    quiz_status: list[dict[str,Any]] = get_report_status(course, quiz)
+    assert len(quiz_status) == 2
+    statuses: list[dict[str, Any]] = []
+    for status in quiz_status:
+        #print(course, status)
+        if 'file' not in status or not recent(status['file']['updated_at']):
+            print('Starting', status['readable_type'], 'report for quiz', status['quiz_id'])
+            status = start_report(course, status)
+        statuses.append(status)
+    return statuses
+
+def fetch_reports(course_IDs: list[int], quizzes: list[int], jobs: int, tmpdir: Path,
+                  cache: Optional[ReportCache] = None) -> Iterator[tuple[int, str, Path]]:
+    """Get the student and item reports for every course that has a quiz.
+    All the reports are requested up front, polled together, and
+    downloaded into TMPDIR, JOBS at a time, as they become ready.  Yields
+    (index into COURSE_IDS, report type, downloaded file) in course order,
+    each as soon as it has arrived, while the later reports are still
+    being polled and downloaded.  Courses whose reports are in CACHE and
+    still recent are not asked about at all."""
+    wanted: list[int] = [i for i in range(len(course_IDs)) if quizzes[i] != 0]
+    order: list[tuple[int, str]] = []
+    downloads: dict[tuple[int, str], Future[Path]] = {}
+    with ThreadPoolExecutor(jobs) as pool:
+        def fetch(key: tuple[int, str], status: dict[str, Any]) -> None:
+            outfile = tmpdir.joinpath('{0}_{1}.csv'.format(*key))
+            downloads[key] = pool.submit(fetch_report, status, outfile, cache)
+
+        def poll_due() -> None:
+            for job in reports.poll():
+                if job.error is not None:
+                    raise job.error
+                if job.timed_out:
+                    raise JobTimeout(job.key, job.status)
+                fetch(job.key, job.status)
+
+        if cache:
+            for i in list(wanted):
+                cached = [cache.report(quizzes[i], report_type)
+                          for report_type in ('student_analysis', 'item_analysis')]
+                if None not in cached:
+                    wanted.remove(i)
+                    for report_type, body in zip(('student_analysis', 'item_analysis'), cached):
+                        downloads[(i, report_type)] = Future()
+                        downloads[(i, report_type)].set_result(cast(Path, body))
+
+        reports = Poller(pool)
+        for i, statuses in zip(wanted, pool.map(lambda i: request_reports(course_IDs[i], quizzes[i]),
+                                                wanted)):
+            for status in statuses:
+                key = (i, status['report_type'])
+                order.append(key)
+                if report_ready(status):
+                    fetch(key, status)
+                else:
+                    reports.add(key, partial(get_one_report_status, course_IDs[i], status),
+                                report_ready, progress=report_progress, **report_polling())
+        order = sorted(set(order) | set(downloads))
+
+        for key in order:
+            # Keep the other reports moving while waiting for this one
+            while key not in downloads:
+                time.sleep(reports.next_delay() or 0)
+                poll_due()
+            future = downloads.pop(key)
+            while reports and not future.done():
+                wait([future], timeout=reports.next_delay())
+                poll_due()
+            yield key[0], key[1], future.result()
+
+class ReportAssembler:
+    """Writes the rows of one kind of quiz report, from every section, to
+    OUTFILE as each section's report arrives, tagging each row with its
+    section.  Each section's copy of the quiz has its own question ids,
+    so the columns are matched by position under the first report's
+    header, never by name.  If RAWFILE is given, the reports are also
+    copied there untouched, one after another."""
+    def __init__(self, outfile: Path, rawfile: Optional[Path] = None):
+        self.outfile = outfile
+        self.out: IO[str] = open(outfile, 'w', newline='')
+        self.raw: Optional[IO[str]] = open(rawfile, 'w', newline='') if rawfile else None
+        self.writer = csv.writer(self.out)
+        self.header: Optional[list[str]] = None
+        self.section_index: int = -1
+        self.appended: bool = False  # Whether the section column was added by us
+        self.items: bool = False
+        self.rows: int = 0
+
+    def add(self, report: Path, section: str) -> None:
+        """Append the rows of the downloaded REPORT for the course SECTION."""
+        with open(report, newline='') as infile:
+            if self.raw is not None:
+                shutil.copyfileobj(infile, self.raw)
+                infile.seek(0)
+            reader = csv.reader(infile)
+            header = next(reader, None)
+            if header is None:
+                return
+            if self.header is None:
+                self.header = header
+                self.items = 'Question Id' in header
+                if 'section' in header:
+                    self.section_index = header.index('section')
+                else:
+                    self.section_index = len(header)
+                    self.appended = True
+                self.writer.writerow(header + ['section'] if self.appended else header)
+            for values in reader:
+                if not values:
+                    continue
+                if len(values) < self.section_index:
+                    values.extend([''] * (self.section_index - len(values)))
                 # Item analysis or empty section in student analysis: add the section
-                if 'Question Id' in row or \
-                        'section' in row and row['section'] == '':
-                    row['section'] = course_names[course_idx]
-                csv_rows.append(row)
-                #print("Added row", len(csv_rows))
-    
-    print(len(csv_rows))
-    assert len(csv_rows) > 0
-    with open(filename.with_stem(filename.stem[:-4]), 'w') as outfile:
-        writer = csv.DictWriter(outfile, fieldnames=csv_rows[0].keys())
-        writer.writeheader()
-        writer.writerows(csv_rows)
-
-def create_reports(course_IDs: list[int], course_names: list[str], quizzes: list[int], outputdir: Path) -> None:
+                if self.appended:
+                    values.insert(self.section_index, section)
+                elif len(values) == self.section_index:
+                    values.append(section)
+                elif self.items or values[self.section_index] == '':
+                    values[self.section_index] = section
+                self.writer.writerow(values)
+                self.rows += 1
+
+    def close(self) -> None:
+        self.out.close()
+        if self.raw is not None:
+            self.raw.close()
+
+def create_reports(course_IDs: list[int], course_names: list[str], quizzes: list[int], outputdir: Path,
+                   jobs: int = 8, keep_raw: bool = False,
+                   cache: Optional[ReportCache] = None) -> None:
     """Takes a list of numeric course ID's, a list of course names, and the directory
     in which to create the output files, and creates student and item reports
-    for the info-literacy quizzes in those courses."""
+    for the info-literacy quizzes in those courses.  Up to JOBS reports are
+    fetched at once, but the output is still in course order.  Each report
+    is written out as it arrives, so memory use stays flat however many
+    sections there are.  With KEEP_RAW, the reports as Canvas sent them
+    are also kept in the *_raw.csv files.  Reports already in CACHE are
+    not downloaded again."""
     # Pre:
     assert len(course_IDs) > 0 and len(course_IDs) == len(course_names) == len(quizzes)
     
@@ -152,47 +271,63 @@ def create_reports(course_IDs: list[int], course_names: list[str], quizzes: list
     if course_names[0].startswith('SSS'):
         course_stem = 'SSS'
 
-    student_report = ''
-    item_report = ''
-    for i in range(len(course_IDs)):
-        if quizzes[i] == 0:
-            continue
-        else:
-            quiz_status: list[dict[str,Any]] = get_report_status(course_IDs[i], quizzes[i])
-            assert len(quiz_status) == 2
-            for status in quiz_status:
-                #print(course_IDs[i], status)
-                newstat = status # To avoid assigning to status if we start a new report
-                if 'file' not in status or not recent(status['file']['updated_at']):
-                    print('Starting', status['readable_type'], 'report for quiz', status['quiz_id'])
-                    newstat = start_report(course_IDs[i], status)
-                report = get_report(course_IDs[i], newstat)
-                if newstat['report_type'] == 'student_analysis':
-                    student_report += report
-                else:
-                    item_report += report
+    assemblers: dict[str, ReportAssembler] = {}
+    for report_type, kind in (('student_analysis', '_students'), ('item_analysis', '_items')):
+        rawfile = outputdir.joinpath(course_stem + kind + '_raw.csv') if keep_raw else None
+        assemblers[report_type] = ReportAssembler(outputdir.joinpath(course_stem + kind + '.csv'),
+                                                  rawfile)
+    try:
+        with TemporaryDirectory() as tmpdir:
+            for i, report_type, report in fetch_reports(course_IDs, quizzes, jobs,
+                                                        Path(tmpdir), cache):
+                assemblers[report_type].add(report, course_names[i])
+                if report.parent == Path(tmpdir):
+                    report.unlink()
+    finally:
+        for assembler in assemblers.values():
+            assembler.close()
 
-    studentfile = outputdir.joinpath(course_stem + '_students_raw.csv')
-    write_report(student_report, studentfile)
-    filter_report(studentfile, course_names)
+    for assembler in assemblers.values():
+        print(assembler.rows, 'rows in', assembler.outfile)
+        assert assembler.rows > 0
 
-    itemfile = outputdir.joinpath(course_stem + '_items_raw.csv')
-    write_report(item_report, itemfile)
-    filter_report(itemfile, course_names)
+def parse_args(argv: list[str]) -> dict[str, Any]:
+    parser = argparse.ArgumentParser(prog='info_lit.py')
+    parser.add_argument('--jobs', default=8, type=int,
+                        help='Number of reports to fetch at once')
+    parser.add_argument('--raw', action='store_true',
+                        help='Also keep the reports as downloaded, in *_raw.csv')
+    parser.add_argument('--refresh', action='store_true',
+                        help='Ask Canvas again for quizzes and reports already in the cache')
+    parser.add_argument('--graphql', action='store_true',
+                        help='Find the quizzes with batched GraphQL queries instead of one request per course')
+    parser.add_argument('--analyze', action='store_true',
+                        help='Compute item, section and year-over-year statistics (needs NumPy)')
+    args = parser.parse_args(argv)
+    return vars(args)
 
 def main(argv: list[str]) -> int:
+    args = parse_args(argv[1:])
+    jobs: int = cast(int, args['jobs'])
+    keep_raw: bool = cast(bool, args['raw'])
     most_recent_fall = 'Fall_2024'
     info_lit_dir = Path.home().joinpath('Documents', 'DEd', 'info-literacy', most_recent_fall)
+    cache = ReportCache(cache_dir(info_lit_dir), refresh=cast(bool, args['refresh']))
+    graphql: Optional[GraphQL] = GraphQL() if args['graphql'] else None
     SSS_courses = read_courses_from_file(info_lit_dir.joinpath('SSS-courses.csv'))
     #print(SSS_courses)
     #print(list(zip(SSS_courses[0], SSS_courses[1])))
-    quizzes: list[int] = find_quiz_numbers(SSS_courses[0])
-    create_reports(SSS_courses[0], SSS_courses[1], quizzes, info_lit_dir)
+    quizzes: list[int] = find_quiz_numbers(SSS_courses[0], cache, graphql)
+    create_reports(SSS_courses[0], SSS_courses[1], quizzes, info_lit_dir, jobs, keep_raw, cache)
 
     FYS_courses = read_courses_from_file(info_lit_dir.joinpath('FYS-courses.csv'))
     #print(FYS_courses)
-    quizzes = find_quiz_numbers(FYS_courses[0])
-    create_reports(FYS_courses[0], FYS_courses[1], quizzes, info_lit_dir)
+    quizzes = find_quiz_numbers(FYS_courses[0], cache, graphql)
+    create_reports(FYS_courses[0], FYS_courses[1], quizzes, info_lit_dir, jobs, keep_raw, cache)
+
+    if args['analyze']:
+        from info_lit_stats import analyze  # Only this needs NumPy
+        analyze(info_lit_dir, ['SSS', 'FYS'])
 
     return 0
 
@@ -0,0 +1,192 @@
+#! /usr/bin/python3
+
+# Statistics for the info-literacy quiz reports that info_lit writes
+# (FYS_students.csv, FYS_items.csv, and the same for SSS), so they no
+# longer have to be worked out by hand in a spreadsheet.  Each report is
+# loaded into NumPy column arrays, and the per-item, per-section and
+# per-year figures are all computed with group-bys over those arrays.
+#
+# NumPy is only needed here, so info_lit imports this module only when
+# asked to --analyze.
+
+from pathlib import Path
+from typing import Any
+import csv
+import re
+import sys
+import time
+import numpy as np
+from filter_csv import write_outfile
+
+Columns = dict[str, np.ndarray]
+
+# Columns of the item analysis report that the item statistics need
+ITEM_COUNTS = ['Answered Student Count', 'Correct Student Count',
+               'Top Student Count', 'Correct Top Student Count',
+               'Bottom Student Count', 'Correct Bottom Student Count']
+
+def load_columns(filename: Path, numeric: list[str], text: list[str]) -> Columns:
+    """Read the CSV file FILENAME into one array per column: the NUMERIC
+    columns as floats (NaN where empty) and the TEXT columns as strings."""
+    with open(filename, newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        rows = list(reader)
+    columns: Columns = {}
+    cells = list(zip(*rows)) if rows else [()] * len(header)
+    for name in numeric:
+        raw = np.array(cells[header.index(name)], dtype=object)
+        raw[raw == ''] = 'nan'
+        columns[name] = raw.astype(float)
+    for name in text:
+        columns[name] = np.array(cells[header.index(name)], dtype=str)
+    return columns
+
+def load_items(filename: Path) -> Columns:
+    """Load an item analysis report.  Since each section has its own copy
+    of the quiz (with its own question ids), a question is identified by
+    its position in the quiz, which is added as the 'position' column."""
+    items = load_columns(filename, ITEM_COUNTS, ['Question Title', 'section'])
+    section = items['section']
+    # Position within the section: rows of a section are contiguous and in quiz order
+    starts = np.flatnonzero(np.r_[True, section[1:] != section[:-1]])
+    lengths = np.diff(np.r_[starts, len(section)])
+    items['position'] = np.arange(len(section)) - np.repeat(starts, lengths) + 1
+    return items
+
+def load_students(filename: Path) -> Columns:
+    return load_columns(filename, ['score'], ['section'])
+
+def group(keys: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Return the distinct KEYS and, for each element, the index of its group."""
+    labels, inverse = np.unique(keys, return_inverse=True)
+    return labels, inverse.ravel()
+
+def group_sum(inverse: np.ndarray, values: np.ndarray, groups: int) -> np.ndarray:
+    return np.bincount(inverse, weights=np.nan_to_num(values), minlength=groups)
+
+def ratio(num: np.ndarray, den: np.ndarray) -> np.ndarray:
+    return np.divide(num, den, out=np.full(len(num), np.nan), where=(den > 0))
+
+def item_statistics(items: Columns) -> Columns:
+    """Pool the per-section item analysis into one row per question.
+    Difficulty is the proportion of students answering correctly, and
+    discrimination the proportion correct among the top students minus
+    that among the bottom students (Canvas's top and bottom 27%)."""
+    positions, inverse = group(items['position'])
+    n = len(positions)
+    sums = {name: group_sum(inverse, items[name], n) for name in ITEM_COUNTS}
+    # Label each question with the title it has in the first section that has it
+    first = np.full(n, len(inverse))
+    np.minimum.at(first, inverse, np.arange(len(inverse)))
+    return {'position': positions,
+            'title': items['Question Title'][first],
+            'sections': np.bincount(inverse, minlength=n),
+            'answered': sums['Answered Student Count'].astype(int),
+            'difficulty': ratio(sums['Correct Student Count'], sums['Answered Student Count']),
+            'discrimination': ratio(sums['Correct Top Student Count'], sums['Top Student Count'])
+                              - ratio(sums['Correct Bottom Student Count'], sums['Bottom Student Count'])}
+
+def score_distribution(keys: np.ndarray, scores: np.ndarray) -> Columns:
+    """Summarise SCORES for each distinct value of KEYS: count, mean,
+    standard deviation, and the five-number summary.  Missing scores
+    (students who never submitted) are left out."""
+    present = ~np.isnan(scores)
+    keys, scores = keys[present], scores[present]
+    labels, inverse = group(keys)
+    n = len(labels)
+    counts = np.bincount(inverse, minlength=n)
+    mean = ratio(np.bincount(inverse, weights=scores, minlength=n), counts)
+    sq_mean = ratio(np.bincount(inverse, weights=scores * scores, minlength=n), counts)
+    std = np.sqrt(np.maximum(sq_mean - mean * mean, 0))
+
+    # Quantiles: sort by group and then score, and interpolate within each group's run
+    ordered = scores[np.lexsort((scores, inverse))]
+    starts = np.r_[0, np.cumsum(counts)[:-1]]
+    result: Columns = {'group': labels, 'n': counts, 'mean': mean, 'std': std}
+    for name, q in (('min', 0), ('q1', 0.25), ('median', 0.5), ('q3', 0.75), ('max', 1)):
+        pos = starts + (counts - 1) * q
+        lo, hi = np.floor(pos).astype(int), np.ceil(pos).astype(int)
+        result[name] = ordered[lo] + (ordered[hi] - ordered[lo]) * (pos - lo)
+    return result
+
+def records(columns: Columns) -> list[dict[str, str]]:
+    """Turn COLUMNS into rows for write_outfile, with floats to 3 places."""
+    def fmt(value: Any) -> str:
+        if isinstance(value, float):
+            return '' if np.isnan(value) else '{0:.3f}'.format(value)
+        return str(value)
+    names = list(columns.keys())
+    return [{name: fmt(value) for name, value in zip(names, row)}
+            for row in zip(*(columns[name].tolist() for name in names))]
+
+def year_dirs(info_lit_dir: Path) -> list[Path]:
+    """Return the directories of every fall's reports beside INFO_LIT_DIR, oldest first."""
+    def year(path: Path) -> int:
+        return int(re.sub(r'\D', '', path.name) or 0)
+    return sorted((d for d in info_lit_dir.parent.glob('Fall_*') if d.is_dir()), key=year)
+
+def compare_years(stem: str, dirs: list[Path]) -> tuple[Columns, Columns]:
+    """Compare the STEM reports of the falls in DIRS: the score distribution
+    of each fall, and the difficulty of each question in each fall."""
+    years: list[np.ndarray] = []
+    scores: list[np.ndarray] = []
+    items: list[Columns] = []
+    for d in dirs:
+        if d.joinpath(stem + '_students.csv').is_file():
+            students = load_students(d.joinpath(stem + '_students.csv'))
+            scores.append(students['score'])
+            years.append(np.full(len(students['score']), d.name))
+        if d.joinpath(stem + '_items.csv').is_file():
+            stats = item_statistics(load_items(d.joinpath(stem + '_items.csv')))
+            stats['year'] = np.full(len(stats['position']), d.name)
+            items.append(stats)
+    by_year = score_distribution(np.concatenate(years), np.concatenate(scores)) if scores else {}
+
+    difficulty: Columns = {}
+    if items:
+        positions, inverse = group(np.concatenate([s['position'] for s in items]))
+        difficulty['position'] = positions
+        offset = 0
+        for stats in items:
+            column = np.full(len(positions), np.nan)
+            column[inverse[offset:offset + len(stats['position'])]] = stats['difficulty']
+            difficulty[stats['year'][0]] = column
+            offset += len(stats['position'])
+    return by_year, difficulty
+
+def analyze(info_lit_dir: Path, stems: list[str]) -> None:
+    """Write the statistics for each of STEMS ('FYS', 'SSS') in INFO_LIT_DIR:
+    <stem>_item_stats.csv and <stem>_section_stats.csv for this fall, and
+    <stem>_year_scores.csv and <stem>_year_items.csv comparing every fall
+    found beside it."""
+    started = time.perf_counter()
+    dirs = year_dirs(info_lit_dir)
+    if info_lit_dir not in dirs:
+        dirs.append(info_lit_dir)
+    for stem in stems:
+        itemfile = info_lit_dir.joinpath(stem + '_items.csv')
+        if itemfile.is_file():
+            write_outfile(records(item_statistics(load_items(itemfile))),
+                          info_lit_dir.joinpath(stem + '_item_stats.csv'))
+        studentfile = info_lit_dir.joinpath(stem + '_students.csv')
+        if studentfile.is_file():
+            students = load_students(studentfile)
+            write_outfile(records(score_distribution(students['section'], students['score'])),
+                          info_lit_dir.joinpath(stem + '_section_stats.csv'))
+        by_year, difficulty = compare_years(stem, dirs)
+        if by_year:
+            write_outfile(records(by_year), info_lit_dir.joinpath(stem + '_year_scores.csv'))
+        if difficulty:
+            write_outfile(records(difficulty), info_lit_dir.joinpath(stem + '_year_items.csv'))
+    print('Analysis took {0:.3f} s'.format(time.perf_counter() - started))
+
+def main(argv: list[str]) -> int:
+    if len(argv) < 2:
+        print('Usage: {0} INFO_LIT_DIR'.format(argv[0]))
+        return 2
+    analyze(Path(argv[1]), ['SSS', 'FYS'])
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
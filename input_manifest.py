@@ -0,0 +1,106 @@
+# Fingerprints of the files each SIS stem is made from, so csv_update can
+# skip a stem (filtering and uploading both) when nothing it depends on
+# has changed since its last upload.  A file's fingerprint is its size,
+# modification time and SHA-256; the checksum is only recomputed when the
+# size or time changed, and a file rewritten with the same contents still
+# counts as unchanged.  The checksum of the filtered output is kept too,
+# so a stem whose output was changed or removed is not skipped.
+#
+# As with the snapshots in sis_delta, the fingerprints of an upload are
+# only pending until its import is known to have finished, so a stem
+# whose import failed is filtered and sent again.
+
+from pathlib import Path
+from typing import Any, Optional
+import json
+import os
+from backup_journal import file_sha256
+
+Fingerprints = dict[str, dict[str, Any]]
+
+# Where the manual override files live (see filter_csv.read_manual_entries)
+def manual_dir() -> Path:
+    return Path(__file__).parent
+
+# The files, other than the input CSV file itself, that each stem's output
+# depends on: its manual overrides, and the fixers that hold the
+# blacklists and substitutions.
+def stem_extras() -> dict[str, list[str]]:
+    return {'Terms': ['fix_terms.py'],
+            'Courses': ['fix_courses.py'],
+            'users': ['manual_users.csv', 'fix_users.py'],
+            'Enrollments': ['manual_enrollments.csv', 'fix_enrollments.py', 'fix_courses.py']}
+
+def stem_inputs(stem: str, data_dirs: dict[str, Path]) -> list[Path]:
+    return [data_dirs['inputdir'].joinpath(stem + '.csv')] + \
+        [manual_dir().joinpath(name) for name in stem_extras().get(stem, [])]
+
+def manifest_file(dir: Path) -> Path:
+    return dir.joinpath('input_manifest.json')
+
+class InputManifest:
+    """The fingerprints recorded at each stem's last upload, kept in DIR."""
+    def __init__(self, dir: Path):
+        self.path = manifest_file(dir)
+        self.entries: dict[str, dict[str, Any]] = \
+            json.loads(self.path.read_text()) if self.path.is_file() else {}
+
+    def fingerprint(self, stem: str, paths: list[Path]) -> Fingerprints:
+        """Return the fingerprints of PATHS, reusing the checksums recorded
+        for STEM where a file's size and modification time are the same."""
+        old: Fingerprints = self.entries.get(stem, {}).get('inputs', {})
+        prints: Fingerprints = {}
+        for path in paths:
+            if not path.is_file():
+                prints[str(path)] = {'missing': True}
+                continue
+            stat = path.stat()
+            entry = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+            previous = old.get(str(path), {})
+            if previous.get('size') == stat.st_size and previous.get('mtime_ns') == stat.st_mtime_ns:
+                entry['sha256'] = previous['sha256']
+            else:
+                entry['sha256'] = file_sha256(path)
+            prints[str(path)] = entry
+        return prints
+
+    def unchanged(self, stem: str, prints: Fingerprints, outfile: Path) -> bool:
+        """Return True if STEM was last uploaded from inputs with the same
+        contents as PRINTS, and its output OUTFILE is still as uploaded."""
+        entry = self.entries.get(stem)
+        if entry is None or 'inputs' not in entry or not outfile.is_file():
+            return False
+        old: Fingerprints = entry['inputs']
+        return old.keys() == prints.keys() \
+            and all(old[p].get('sha256') == prints[p].get('sha256') for p in prints) \
+            and file_sha256(outfile) == entry['output_sha256']
+
+    def record(self, stem: str, prints: Fingerprints, outfile: Path,
+               upload_id: Optional[int] = None) -> None:
+        """Record that STEM's output OUTFILE, made from inputs with PRINTS,
+        has been uploaded: as pending the import UPLOAD_ID, or as current
+        if Canvas already has it (UPLOAD_ID None)."""
+        entry = {'inputs': prints, 'output_sha256': file_sha256(outfile)}
+        if upload_id is None:
+            self.entries[stem] = entry
+        else:
+            self.entries.setdefault(stem, {})['pending'] = dict(entry, upload_id=upload_id)
+        self.save()
+
+    def promote(self, upload_id: int) -> None:
+        """Make current every pending record whose import, UPLOAD_ID, has
+        now finished successfully."""
+        promoted = False
+        for stem, entry in self.entries.items():
+            pending = entry.get('pending')
+            if pending is not None and pending['upload_id'] == upload_id:
+                del pending['upload_id']
+                self.entries[stem] = pending
+                promoted = True
+        if promoted:
+            self.save()
+
+    def save(self) -> None:
+        tmpfile = self.path.with_name(self.path.name + '.tmp')
+        tmpfile.write_text(json.dumps(self.entries, indent=1))
+        os.replace(tmpfile, self.path)
@@ -0,0 +1,153 @@
+# Adaptive polling of long-running Canvas jobs (content exports, quiz
+# reports, SIS imports).  One Poller tracks any number of outstanding
+# jobs, each with its own exponential backoff, and uses reported progress
+# (where the job has any) to guess when the job will be done.
+
+from concurrent.futures import Executor
+from typing import Any, Callable, Hashable, Iterator, Optional
+import time
+
+Status = dict[str, Any]
+
+class JobTimeout(Exception):
+    """Raised when a job is still unfinished after its maximum wait."""
+    def __init__(self, key: Hashable, status: Status):
+        super().__init__('Maximum wait exceeded for {0}'.format(key))
+        self.key = key
+        self.status = status
+
+class Job:
+    """One outstanding job.  CHECK fetches the job's current status,
+    FINISHED says whether a status is final, and PROGRESS (optional)
+    extracts a completion percentage from a status.  A CHECK that raises
+    (a Canvas 5xx, a socket timeout) is tried again on the usual
+    schedule; after MAX_ERRORS failures in a row, the job is given up
+    with the last exception in ERROR."""
+    def __init__(self, key: Hashable, check: Callable[[], Status],
+                 finished: Callable[[Status], bool],
+                 progress: Optional[Callable[[Status], Optional[float]]] = None,
+                 first_delay: float = 0, min_delay: float = 2,
+                 max_delay: float = 60, backoff: float = 1.5,
+                 max_wait: float = 1000, status: Optional[Status] = None,
+                 max_errors: int = 3):
+        self.key = key
+        self.check = check
+        self.finished = finished
+        self.progress = progress
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.backoff = backoff
+        self.max_wait = max_wait
+        self.max_errors = max_errors
+        self.status: Status = status or {}
+        self.started: float = time.monotonic()
+        self.next_poll: float = self.started + first_delay
+        self.delay: float = min_delay
+        self.polls: int = 0
+        self.timed_out: bool = False
+        self.errors: int = 0  # Failed checks in a row
+        self.error: Optional[Exception] = None
+        self.last_progress: Optional[tuple[float, float]] = None  # (time, percent)
+
+    def estimate_delay(self, now: float) -> float:
+        """Work out how long to wait before the next poll.  If the job's
+        progress moved since the last poll, aim for the projected finish;
+        otherwise back off exponentially."""
+        delay = self.delay
+        self.delay = min(self.delay * self.backoff, self.max_delay)
+        percent = self.progress(self.status) if self.progress else None
+        if percent is not None:
+            if self.last_progress is not None and percent > self.last_progress[1] \
+                    and now > self.last_progress[0]:
+                rate = (percent - self.last_progress[1]) / (now - self.last_progress[0])
+                delay = (100 - percent) / rate
+                self.delay = self.min_delay  # Moving again, so start backoff over
+            self.last_progress = (now, percent)
+        return max(self.min_delay, min(delay, self.max_delay))
+
+    def poll(self) -> bool:
+        """Fetch the job's status.  Returns True if the job is finished,
+        has run out of time or has failed too often, and otherwise
+        schedules the next poll."""
+        try:
+            status = self.check()
+        except Exception as e:
+            self.errors += 1
+            self.error = e
+        else:
+            self.status = status
+            self.errors = 0
+            self.error = None
+        self.polls += 1
+        now = time.monotonic()
+        if self.error is not None:
+            if self.errors >= self.max_errors:
+                return True
+        elif self.finished(self.status):
+            return True
+        if now - self.started > self.max_wait:
+            self.timed_out = True
+            return True
+        self.next_poll = now + self.estimate_delay(now)
+        return False
+
+class Poller:
+    """Scheduler for many outstanding jobs.  Jobs that are due get polled
+    together (on EXECUTOR, if given), and finished jobs are handed back
+    in the order they finish."""
+    def __init__(self, executor: Optional[Executor] = None):
+        self.executor = executor
+        self.jobs: dict[Hashable, Job] = {}
+
+    def __len__(self) -> int:
+        return len(self.jobs)
+
+    def add(self, key: Hashable, check: Callable[[], Status],
+            finished: Callable[[Status], bool], **options: Any) -> Job:
+        """Start tracking a job under KEY.  OPTIONS are passed on to Job."""
+        job = Job(key, check, finished, **options)
+        self.jobs[key] = job
+        return job
+
+    def next_delay(self) -> Optional[float]:
+        """Seconds until the next job is due, or None if there are no jobs."""
+        if not self.jobs:
+            return None
+        return max(0.0, min(job.next_poll for job in self.jobs.values()) - time.monotonic())
+
+    def poll(self) -> list[Job]:
+        """Poll every job that is due.  Returns the jobs that finished,
+        timed out or failed (see Job.error), which are no longer tracked."""
+        now = time.monotonic()
+        due = [job for job in self.jobs.values() if job.next_poll <= now]
+        if self.executor is not None and len(due) > 1:
+            results = list(self.executor.map(Job.poll, due))
+        else:
+            results = [job.poll() for job in due]
+        done = [job for job, finished in zip(due, results) if finished]
+        for job in done:
+            del self.jobs[job.key]
+        return done
+
+    def run(self) -> Iterator[Job]:
+        """Yield jobs as they finish (or time out) until none are left.
+        Jobs may be added between iterations."""
+        while self.jobs:
+            delay = self.next_delay()
+            if delay:
+                time.sleep(delay)
+            yield from self.poll()
+
+def wait_for(check: Callable[[], Status], finished: Callable[[Status], bool],
+             key: Hashable = 'job', **options: Any) -> Status:
+    """Poll a single job until it finishes, and return its final status.
+    Raises JobTimeout if it does not finish within its maximum wait, and
+    the last error if checking it failed too many times in a row."""
+    poller = Poller()
+    job = poller.add(key, check, finished, **options)
+    for job in poller.run():
+        if job.error is not None:
+            raise job.error
+        if job.timed_out:
+            raise JobTimeout(job.key, job.status)
+    return job.status
@@ -0,0 +1,87 @@
+# On-disk cache for info_lit, so that reruns only ask Canvas about what
+# may have changed.  It keeps two things: the id of the info-fluency quiz
+# in each course, and the body of each finished quiz report, stored under
+# the quiz, the report type and the updated_at of the report's file.
+#
+# Both indexes are JSON-lines files (see backup_journal), and the report
+# bodies are plain CSV files next to them.
+
+from pathlib import Path
+from typing import Any, Optional
+import os
+import shutil
+import threading
+from backup_journal import append_jsonl, read_jsonl
+from course_backups import recent
+
+def cache_dir(info_lit_dir: Path) -> Path:
+    return info_lit_dir.joinpath('cache')
+
+def report_key(quiz: int, report_type: str) -> str:
+    return '{0}/{1}'.format(quiz, report_type)
+
+class ReportCache:
+    """The cache under DIRECTORY.  With REFRESH, nothing is read from the
+    cache, but everything fetched is still written to it."""
+    def __init__(self, directory: Path, refresh: bool = False):
+        self.dir = directory
+        self.refresh = refresh
+        self.quiz_file = directory.joinpath('quizzes.jsonl')
+        self.report_file = directory.joinpath('reports.jsonl')
+        self.quizzes: dict[Any, dict[str, Any]] = read_jsonl(self.quiz_file, 'course')
+        self.reports: dict[Any, dict[str, Any]] = read_jsonl(self.report_file, 'key')
+        self.lock = threading.Lock()
+        directory.joinpath('reports').mkdir(parents=True, exist_ok=True)
+
+    def quiz(self, course: int) -> Optional[int]:
+        """Return the info-fluency quiz id recorded for COURSE, if any.
+        Courses found to have no quiz are not cached, since one may be
+        added later."""
+        if self.refresh or str(course) not in self.quizzes:
+            return None
+        return int(self.quizzes[str(course)]['quiz'])
+
+    def record_quiz(self, course: int, quiz: int) -> None:
+        if quiz == 0 or self.quizzes.get(str(course), {}).get('quiz') == quiz:
+            return
+        entry = {'course': str(course), 'quiz': quiz}
+        with self.lock:
+            self.quizzes[str(course)] = entry
+            append_jsonl(self.quiz_file, entry)
+
+    def report(self, quiz: int, report_type: str, updated_at: Optional[str] = None) -> Optional[Path]:
+        """Return the cached body of QUIZ's REPORT_TYPE report.  If
+        UPDATED_AT is given, only a body of the report file last updated
+        then will do; otherwise any body still recent enough that Canvas
+        would not be asked for a new report."""
+        entry = self.reports.get(report_key(quiz, report_type))
+        if self.refresh or entry is None:
+            return None
+        if updated_at is None and not recent(entry['updated_at']):
+            return None
+        if updated_at is not None and entry['updated_at'] != updated_at:
+            return None
+        body = self.dir.joinpath('reports', entry['file'])
+        return body if body.is_file() else None
+
+    def store_report(self, status: dict[str, Any], downloaded: Path) -> Path:
+        """Move the DOWNLOADED body of the finished report with STATUS into
+        the cache, dropping any older body of the same report, and return
+        where it now is."""
+        key = report_key(status['quiz_id'], status['report_type'])
+        updated_at: str = status['file']['updated_at']
+        name = '{0}_{1}_{2}.csv'.format(status['quiz_id'], status['report_type'],
+                                        ''.join(c for c in updated_at if c.isalnum()))
+        body = self.dir.joinpath('reports', name)
+        shutil.move(downloaded, body)
+        entry = {'key': key, 'file': name, 'updated_at': updated_at}
+        with self.lock:
+            old = self.reports.get(key)
+            self.reports[key] = entry
+            append_jsonl(self.report_file, entry)
+        if old is not None and old['file'] != name:
+            try:
+                os.remove(self.dir.joinpath('reports', old['file']))
+            except FileNotFoundError:
+                pass
+        return body
@@ -0,0 +1,140 @@
+# Delta SIS uploads.  For each stem, a snapshot is kept of the last output
+# that Canvas imported successfully.  The next upload then sends only the
+# rows that were added or changed since, keyed as in stem_keys(), and
+# nothing at all if no row changed.  Rows that disappear are not sent;
+# as with full uploads, Canvas takes no action on a missing row.
+#
+# A snapshot only becomes current once its import is known to have
+# finished: until then it is kept as <stem>.pending.csv, along with the
+# id of the import.  A full upload is still made now and then (see
+# full_sync_interval()), and whenever there is no usable snapshot.
+
+from datetime import datetime, timedelta, timezone
+from itertools import chain
+from pathlib import Path
+from typing import Any, Optional
+import json
+import os
+import shutil
+from filter_csv import iter_csv, write_stream
+
+# Columns identifying a row of each stem.  Stems not listed are always
+# uploaded in full.
+def stem_keys() -> dict[str, tuple[str, ...]]:
+    return {'Enrollments': ('user_id', 'course_id', 'role', 'section_id'),
+            'users': ('user_id',),
+            'Courses': ('course_id',),
+            'Terms': ('term_id', 'date_override_enrollment_type'),
+            'accounts': ('account_id',)}
+
+def full_sync_interval() -> timedelta:
+    return timedelta(days=7)
+
+def snapshot_dir(dir: Path) -> Path:
+    return dir.joinpath('snapshots')
+
+def delta_dir(dir: Path) -> Path:
+    return dir.joinpath('delta')
+
+def snapshot_file(stem: str, dir: Path, pending: bool = False) -> Path:
+    return snapshot_dir(dir).joinpath(stem + ('.pending' if pending else '') + '.csv')
+
+def info_file(stem: str, dir: Path, pending: bool = False) -> Path:
+    return snapshot_dir(dir).joinpath(stem + ('.pending' if pending else '') + '.json')
+
+def read_info(path: Path) -> dict[str, Any]:
+    return json.loads(path.read_text()) if path.is_file() else {}
+
+def write_info(path: Path, info: dict[str, Any]) -> None:
+    tmpfile = path.with_name(path.name + '.tmp')
+    tmpfile.write_text(json.dumps(info))
+    os.replace(tmpfile, path)
+
+def read_snapshot(path: Path, key: tuple[str, ...]) -> tuple[list[str], dict[tuple[Any, ...], tuple[Any, ...]]]:
+    """Read the snapshot at PATH, returning its header and its rows keyed
+    by the columns in KEY."""
+    header: list[str] = []
+    rows: dict[tuple[Any, ...], tuple[Any, ...]] = {}
+    for row in iter_csv(path):
+        if not header:
+            header = list(row.keys())
+        rows[tuple(row.get(k) for k in key)] = tuple(row.values())
+    return header, rows
+
+def needs_full_sync(stem: str, dir: Path) -> bool:
+    """Return True if STEM has to be uploaded in full: it has no key,
+    there is no snapshot, or the last full upload is too long ago."""
+    info = read_info(info_file(stem, dir))
+    if stem not in stem_keys() or not snapshot_file(stem, dir).is_file() or 'full_sync_at' not in info:
+        return True
+    last_full = datetime.fromisoformat(info['full_sync_at'])
+    return datetime.now(timezone.utc) - last_full > full_sync_interval()
+
+def write_delta(stem: str, dir: Path) -> Optional[int]:
+    """Write the rows of STEM's output in DIR that are new or changed since
+    the snapshot into the delta directory.  Returns the number of rows, or
+    None if the output cannot be compared with the snapshot (its columns
+    differ), so a full upload is needed."""
+    key = stem_keys()[stem]
+    rows = iter_csv(dir.joinpath(stem + '.csv'))
+    first = next(rows, None)
+    if first is None:
+        return 0
+    if any(k not in first for k in key):
+        print('Columns of', stem, 'do not include', key)
+        return None
+    header, old_rows = read_snapshot(snapshot_file(stem, dir), key)
+    if list(first.keys()) != header:
+        print('Columns of', stem, 'changed since the snapshot')
+        return None
+
+    delta_dir(dir).mkdir(parents=True, exist_ok=True)
+    return write_stream((row for row in chain([first], rows)
+                         if old_rows.get(tuple(row[k] for k in key)) != tuple(row.values())),
+                        delta_dir(dir).joinpath(stem + '.csv'))
+
+def prepare_upload(stem: str, dir: Path, full: bool = False) -> tuple[Optional[Path], bool]:
+    """Work out what to upload for STEM: the whole output in DIR if FULL is
+    set or a full sync is due, otherwise just the rows that changed.
+    Returns the file to upload (None if nothing changed, or if the output
+    has no rows at all) and whether it is a full upload."""
+    if next(iter_csv(dir.joinpath(stem + '.csv')), None) is None:
+        # An empty input (or a filter gone wrong) must not be posted as the
+        # whole of STEM, nor replace the snapshot of what Canvas has
+        print('No rows of', stem, 'to upload; skipping it')
+        return None, False
+    if not full and not needs_full_sync(stem, dir):
+        count = write_delta(stem, dir)
+        if count == 0:
+            # Nothing for Canvas to do, but removed rows leave the snapshot
+            shutil.copyfile(dir.joinpath(stem + '.csv'), snapshot_file(stem, dir))
+            return None, False
+        if count is not None:
+            print('Uploading', count, 'changed rows of', stem)
+            return delta_dir(dir).joinpath(stem + '.csv'), False
+    print('Uploading all of', stem)
+    return dir.joinpath(stem + '.csv'), True
+
+def mark_pending(stem: str, dir: Path, upload_id: int, full: bool) -> None:
+    """Keep STEM's current output in DIR as the snapshot to adopt once the
+    import UPLOAD_ID has finished."""
+    snapshot_dir(dir).mkdir(parents=True, exist_ok=True)
+    shutil.copyfile(dir.joinpath(stem + '.csv'), snapshot_file(stem, dir, pending=True))
+    write_info(info_file(stem, dir, pending=True), {'upload_id': upload_id, 'full': full})
+
+def promote_snapshots(dir: Path, upload_id: int) -> None:
+    """Make current every pending snapshot whose import, UPLOAD_ID, has
+    now finished successfully."""
+    for pending_info in snapshot_dir(dir).glob('*.pending.json'):
+        pending = read_info(pending_info)
+        if pending.get('upload_id') != upload_id:
+            continue
+        stem = pending_info.name[:-len('.pending.json')]
+        info = read_info(info_file(stem, dir))
+        now = datetime.now(timezone.utc).isoformat()
+        info.update(upload_id=upload_id, imported_at=now)
+        if pending.get('full'):
+            info['full_sync_at'] = now
+        os.replace(snapshot_file(stem, dir, pending=True), snapshot_file(stem, dir))
+        write_info(info_file(stem, dir), info)
+        pending_info.unlink()
@@ -0,0 +1,50 @@
+# Status of a long-running csv_update (--daemon or --watch), kept in a
+# one-line JSON file beside the upload lockfile, so the Nagios check can
+# tell how the syncing is going by reading a file, without running ps or
+# autofix.  Times are whole seconds since the epoch, which the check can
+# compare with bash arithmetic.
+
+from pathlib import Path
+from typing import Any
+import json
+import os
+import time
+from canvas_api import constants
+
+def status_file(dir: Path) -> Path:
+    return dir.joinpath(constants()['host'] + '-status.json')
+
+def read_status(dir: Path) -> dict[str, Any]:
+    path = status_file(dir)
+    return json.loads(path.read_text()) if path.is_file() else {}
+
+class SyncStatus:
+    """The status of this process's sync cycles, written to DIR each time
+    it changes.  STATE is 'starting', 'running', 'idle', 'failed' or
+    'stopped'."""
+    def __init__(self, dir: Path, mode: str):
+        self.path = status_file(dir)
+        self.status: dict[str, Any] = {'state': 'starting', 'pid': os.getpid(), 'mode': mode,
+                                       'since': int(time.time()), 'cycle_started': 0,
+                                       'cycle_finished': 0, 'next_cycle': 0, 'last_upload': -1,
+                                       'cycles': 0, 'failures': 0, 'message': ''}
+        self.update()
+
+    def update(self, **fields: Any) -> None:
+        self.status.update(fields, updated=int(time.time()))
+        tmpfile = self.path.with_name(self.path.name + '.tmp')
+        tmpfile.write_text(json.dumps(self.status) + '\n')
+        os.replace(tmpfile, self.path)
+
+    def cycle_started(self, stems: list[str]) -> None:
+        self.update(state='running', cycle_started=int(time.time()),
+                    message='Syncing ' + ', '.join(stems))
+
+    def cycle_finished(self, last_upload: int) -> None:
+        self.update(state='idle', cycle_finished=int(time.time()), last_upload=last_upload,
+                    cycles=self.status['cycles'] + 1, message='')
+
+    def cycle_failed(self, message: str) -> None:
+        self.update(state='failed', cycle_finished=int(time.time()),
+                    cycles=self.status['cycles'] + 1, failures=self.status['failures'] + 1,
+                    message=message.replace('\n', ' ')[:200])
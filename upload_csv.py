@@ -5,38 +5,20 @@
 from datetime import datetime
 from pathlib import Path
 from typing import Any, cast, Union
-import json
-import os
-import subprocess
-import time
-
-# Set constants, using a dict instead of global variables
-def constants() -> dict[str, str]:
-    return { #'host': 'converse.beta.instructure.com',
-             'host': 'converse.instructure.com',
-             'tokenfile': 'tokens.json' }
-
-# Get the access token for the host we're using
-def get_access_token(suffix:str = '') -> str:
-    tokfile = Path.home().joinpath('.ssh', (constants()['tokenfile']))
-    data: dict[str, Any] = json.loads(tokfile.read_text())
-    key: str = constants()['host'] + suffix
-    #print(key)
-    return cast(str, data[key])
-
-def last_upload_file(dir:Path) -> Path:
-    return dir.joinpath(constants()['host'] + '-upload.txt')
-
-# Out here so it can be imported elsewhere
-def working_prefix() -> str:
-    return 'Working:'
-
-def working_msg(pid: int, last_upload: int) -> str:
-    return working_prefix() + ' pid {0} last was {1}'.format(pid, last_upload)
-
+import zipfile
+from canvas_api import api_url, constants, get_access_token, get_json, post_json
+from poller import JobTimeout, wait_for
+from sis_delta import mark_pending, prepare_upload, promote_snapshots
+
+# Prefixes of the errors raised when an import times out or ends up in
+# an illegal state, and of a run that was stopped (SIGTERM or ^C) part
+# way.  upload_lock records which of them ended a run.
 def timeout_prefix() -> str:
     return 'Timed out:'
 
+def interrupted_prefix() -> str:
+    return 'Interrupted:'
+
 def illegal_state_prefix() -> str:
     return 'Illegal state:'
 
@@ -48,56 +30,6 @@ def record_saving_throw(dir: Path, contents: str) -> None:
     with open(record_fname, 'a') as f:
         f.write(msg)
 
-# Get the ID number of the last upload from the file where it's stored.
-# If there is no such file, just return -1 (no job).
-def get_last_upload(dir: Path) -> int:
-    last_upload: int = -1
-    prefix: str = ''
-    fname: Path = last_upload_file(dir)
-    if fname.exists():
-        contents: str = fname.read_text()
-        tokens: list[str] = contents.split()
-        last_upload = int(tokens[-1]) # If the last token isn't a number, we're done.
-        prefix = ' '.join(tokens[:-1]) # Returns '' if the number is the only thing
-
-        if prefix == illegal_state_prefix():
-            raise RuntimeError(contents)
-        elif prefix.startswith(timeout_prefix()):
-            record_saving_throw(dir, contents)
-        elif prefix.startswith(working_prefix()):
-            # Check whether the PID is still running
-            pid: int = int(tokens[2])
-            cmd = ['ps', '--no-headers', '--format', 
-                   'pid,stat,time,cmd', '--pid',
-                   str(pid)]
-            try:
-                output: str = bytesOrStrPrintable(subprocess.check_output(cmd))
-            except subprocess.CalledProcessError as e:
-                record_saving_throw(dir, contents)
-                output = e.output
-            else:
-                # Still running, raise RuntimeError
-                raise RuntimeError(contents)
-
-	# os.pid() to get current PID
-        # os.kill(pid, signal); signal is signal.SIGKILL on Unix
-        # I see nothing to query the status of another process; use 'ps" instead
-        # ps --format pid,stat,time,cmd --no-headers --pid pid
-        # output iff the proc exists
-
-    # If a task starts before this one ends, make the other one fail fast.
-    # The other one will try to read a number from the file and crash.
-    # Effectively, this provides a file lock for the process.
-    fname.write_text(working_msg(os.getpid(), last_upload))
-
-    return last_upload
-
-# Write the ID number of the last upload to the file.
-# Alternatively, a preformatted message can be written.
-def write_last_upload(idnum: Union[int, str], dir: Path) -> None:
-    fname:Path = last_upload_file(dir)
-    fname.write_text(str(idnum))
-
 # Take a byte sequence or a string and return a string, so it's known
 # to be printable.
 def bytesOrStrPrintable(instring: Union[str, bytes]) -> str:
@@ -109,59 +41,115 @@ def bytesOrStrPrintable(instring: Union[str, bytes]) -> str:
         pass
     return cast(str, outstring)
 
+# Get the status of the upload with id IDNUM from Canvas.
+def get_upload_status(idnum: int) -> dict[str, Any]:
+    data: dict[str, Any] = get_json(api_url('accounts/self/sis_imports/{0}'.format(idnum)))
+    return data
+
+# Check whether the upload with id IDNUM, whose status is DATA, has
+# finished yet.
+def upload_status_complete(idnum: int, data: dict[str, Any]) -> bool:
+    complete = False
+    #print(data)
+    if data['progress'] == 100 \
+       and data['workflow_state'].startswith('imported'):
+        complete = True
+    elif data['workflow_state'] not in ('created', 'importing'):
+        print(data)
+        raise RuntimeError(illegal_state_prefix() + ' ' + str(idnum))
+    else:
+        # Gives some visual feedback if we have to wait for completion
+        print(data['progress'], data['workflow_state'])
+    return complete
+
 # Check whether the upload with id IDNUM has finished yet.
 def upload_complete(idnum: int) -> bool:
     complete = (idnum == -1)
     if not complete:
-        token = get_access_token()
-        cmd = ['curl', '--silent', '--show-error', 
-               '-H', "Authorization: Bearer " + token,
-               ('https://{0}/api/v1/accounts/self/sis_imports/' +
-                '{1}').format(constants()['host'], idnum)]
-        output:str = bytesOrStrPrintable(subprocess.check_output(cmd))
-        #print(output)
-        data = json.loads(output)
-        if data['progress'] == 100 \
-           and data['workflow_state'].startswith('imported'):
-            complete = True
-        elif data['workflow_state'] not in ('created', 'importing'):
-            print(output)
-            raise RuntimeError(illegal_state_prefix() + ' ' + str(idnum))
-        else:
-            # Gives some visual feedback if we have to wait for completion
-            print(data['progress'], data['workflow_state'])
+        complete = upload_status_complete(idnum, get_upload_status(idnum))
     return complete
 
-# Wait for the upload with id LAST_UPLOAD to complete, using a loop.
+# Polling parameters for SIS imports.  Imports report their progress, so
+# the poller can aim for the projected finish instead of a fixed step.
+def import_polling() -> dict[str, Any]:
+    return { 'min_delay': 2, 'max_delay': 60, 'max_wait': 1000 }
+
+# Wait for the upload with id LAST_UPLOAD to complete, using the poller.
 # If the upload takes *too* long, raise an exception.
 def wait_for_upload_complete(last_upload: int) -> bool:
-    max_wait = 1000 # Max time to wait (seconds)
-    wait_step = 5  # Wait time each time around the loop (seconds)
-    waited = 0     # Time waited so far (seconds)
-    while waited < max_wait and not upload_complete(last_upload):
-        waited = waited + wait_step
-        time.sleep(wait_step)
-    if waited >= max_wait:
-        raise RuntimeError(timeout_prefix() + ' ' + str(last_upload))
+    if last_upload != -1:
+        try:
+            wait_for(lambda: get_upload_status(last_upload),
+                     lambda data: upload_status_complete(last_upload, data),
+                     key=last_upload, progress=lambda data: data['progress'],
+                     **import_polling())
+        except JobTimeout:
+            raise RuntimeError(timeout_prefix() + ' ' + str(last_upload))
     return True # If we get here, the upload completed successfully
 
+# Wait for the upload with id LAST_UPLOAD to complete, and then make
+# current the snapshots that were waiting on it (see sis_delta).
+def confirm_upload(dir: Path, last_upload: int) -> None:
+    wait_for_upload_complete(last_upload)
+    if last_upload != -1:
+        promote_snapshots(dir, last_upload)
+
 # Upload a CSV file to Canvas.  Return the ID of the upload job, so it
 # can be checked whether the job is done before starting another.
-def upload(stem: str, dir: Path, last_upload: int) -> int:
+# Only the rows changed since the last successful import are sent,
+# unless FULL is set or a full sync is due (see sis_delta).  If nothing
+# changed, nothing is uploaded and LAST_UPLOAD is returned.
+def upload(stem: str, dir: Path, last_upload: int, full: bool = False) -> int:
     # First, figure out if the previous upload succeeded.
-    wait_for_upload_complete(last_upload)
+    confirm_upload(dir, last_upload)
+
+    uploadfile, full = prepare_upload(stem, dir, full)
+    if uploadfile is None:
+        print('No changes to upload')
+        print()
+        return last_upload
 
     # Next, do this upload
-    token = get_access_token()
-    cmd = ['curl', '--silent', '--show-error',
-           '-F', 'attachment=@' + str(dir.joinpath(stem + '.csv')),
-           '-H', "Authorization: Bearer " + token,
-           'https://' + constants()['host'] + '/api/v1/accounts/self/sis_imports.json?import_type=instructure_csv']
     # Lots of ways for things to go wrong in here, none of which can
     # reasonably be caught.  Therefore, don't bother with try-except.
-    output = bytesOrStrPrintable(subprocess.check_output(cmd))
-    resultval = json.loads(output)
+    resultval = post_json(api_url('accounts/self/sis_imports.json?import_type=instructure_csv'),
+                          files={'attachment': uploadfile})
+    uploadID: int = cast(int, resultval['id'])
+    mark_pending(stem, dir, uploadID, full)
+    print('Upload ID:', uploadID)
+    print()
+    return uploadID
+
+def bundle_file(dir: Path) -> Path:
+    return dir.joinpath('bundle.zip')
+
+# Upload several CSV files to Canvas as one compressed zip file, so that
+# Canvas runs a single import for all of them instead of one per stem.
+# As with upload(), each stem contributes only its changed rows unless
+# FULL is set, and stems with no changes are left out.  Returns the ID
+# of the upload job, or LAST_UPLOAD if there was nothing to upload.
+def upload_bundle(stems: list[str], dir: Path, last_upload: int, full: bool = False) -> int:
+    confirm_upload(dir, last_upload)
+
+    parts: dict[str, bool] = {}  # Whether each stem in the bundle is a full upload
+    with zipfile.ZipFile(bundle_file(dir), 'w', compression=zipfile.ZIP_DEFLATED) as bundle:
+        for stem in stems:
+            uploadfile, parts[stem] = prepare_upload(stem, dir, full)
+            if uploadfile is None:
+                del parts[stem]
+            else:
+                bundle.write(uploadfile, stem + '.csv')
+    if not parts:
+        print('No changes to upload')
+        print()
+        return last_upload
+    print('Bundled', ', '.join(parts), 'into', bundle_file(dir).stat().st_size, 'bytes')
+
+    resultval = post_json(api_url('accounts/self/sis_imports.json?import_type=instructure_csv&extension=zip'),
+                          files={'attachment': bundle_file(dir)})
     uploadID: int = cast(int, resultval['id'])
+    for stem, stem_full in parts.items():
+        mark_pending(stem, dir, uploadID, stem_full)
     print('Upload ID:', uploadID)
     print()
     return uploadID
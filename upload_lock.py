@@ -0,0 +1,195 @@
+#! /usr/bin/python3
+
+# Coordination of the runs that upload to Canvas.  Only one run may
+# upload at a time, and it shows this by holding an exclusive flock on
+# <host>-upload.lock.  The kernel drops the lock the moment the process
+# exits, however it exits, so a crashed run never leaves a stale lock
+# behind.
+#
+# While it holds the lock, the run keeps a heartbeat record up to date
+# in <host>-upload.json: its stage, the ID of the last import it
+# started, and when it last checked in.  The record outlives the run.
+# The next run therefore knows which import to wait for, and whether the
+# last run finished, timed out, found an import in an illegal state, was
+# stopped on purpose, or died part way.  A record that says 'working' while nobody holds the
+# lock (or whose pid is gone, for the Nagios check) is a crashed run.
+#
+# This replaces <host>-upload.txt, where a run wrote "Working: pid N last
+# was M" and the next one asked ps whether pid N was still alive.
+#
+# Usage: upload_lock.py [--clear]
+# Shows the record, and with --clear marks it idle again (after an
+# illegal state has been looked into).
+
+from pathlib import Path
+from typing import Any, Optional
+import fcntl
+import json
+import os
+import sys
+import threading
+import time
+from canvas_api import constants
+from upload_csv import illegal_state_prefix, interrupted_prefix, record_saving_throw, timeout_prefix
+
+HEARTBEAT_INTERVAL = 10  # seconds
+
+def lock_file(dir: Path) -> Path:
+    return dir.joinpath(constants()['host'] + '-upload.lock')
+
+def heartbeat_file(dir: Path) -> Path:
+    return dir.joinpath(constants()['host'] + '-upload.json')
+
+# The file of the old protocol, read once to carry the last upload over
+def legacy_file(dir: Path) -> Path:
+    return dir.joinpath(constants()['host'] + '-upload.txt')
+
+def legacy_record(dir: Path) -> dict[str, Any]:
+    """Turn the old text lockfile in DIR, if any, into a heartbeat record."""
+    if not legacy_file(dir).is_file():
+        return {}
+    contents = legacy_file(dir).read_text().strip()
+    tokens = contents.split()
+    record: dict[str, Any] = {'state': 'idle', 'message': ''}
+    if tokens and tokens[-1].isdigit():
+        record['last_upload'] = int(tokens[-1])
+    if contents.startswith(illegal_state_prefix()):
+        record.update(state='illegal_state', message=contents)
+    elif contents.startswith(timeout_prefix()):
+        record.update(state='timed_out', message=contents)
+    elif contents.startswith('Working:'):
+        record.update(state='working', message=contents)
+    return record
+
+def read_heartbeat(dir: Path) -> dict[str, Any]:
+    path = heartbeat_file(dir)
+    return json.loads(path.read_text()) if path.is_file() else legacy_record(dir)
+
+def lock_held(dir: Path) -> bool:
+    """Return True if some run holds the upload lock in DIR."""
+    fd = os.open(lock_file(dir), os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return True
+    finally:
+        os.close(fd)  # Closing drops the shared lock too
+    return False
+
+def needs_recovery(dir: Path) -> bool:
+    """Return True if the last run in DIR died part way, or failed with
+    an error other than a timeout or an illegal state, and nothing has
+    run since."""
+    return read_heartbeat(dir).get('state') in ('working', 'failed') and not lock_held(dir)
+
+def describe(record: dict[str, Any]) -> str:
+    return '{0} (pid {1}, {2}) last was {3}{4}'.format(
+        record.get('state'), record.get('pid'), record.get('stage') or 'no stage',
+        record.get('last_upload', -1), ': ' + record['message'] if record.get('message') else '')
+
+class UploadLock:
+    """The right to upload to Canvas from DIR, with the heartbeat record
+    refreshed every INTERVAL seconds while it is held."""
+    def __init__(self, dir: Path, interval: float = HEARTBEAT_INTERVAL):
+        self.dir = dir
+        self.interval = interval
+        self.fd: Optional[int] = None
+        self.record: dict[str, Any] = {}
+        self.writing = threading.Lock()
+        self.stopping = threading.Event()
+        self.beating: Optional[threading.Thread] = None
+
+    def acquire(self) -> int:
+        """Take the lock and return the ID of the last upload (-1 if
+        none).  Raises RuntimeError if another run holds the lock, or if
+        the last import was found in an illegal state."""
+        self.lock()
+        record = read_heartbeat(self.dir)
+        if record.get('state') == 'illegal_state':
+            self.unlock()
+            raise RuntimeError(record.get('message') or describe(record))
+        if record.get('state') in ('working', 'timed_out', 'failed'):
+            # The last run died, timed out or failed; carry on from its last
+            # upload.  An interrupted run was stopped on purpose, so needs no note.
+            record_saving_throw(self.dir, describe(record))
+
+        now = int(time.time())
+        self.record = {'state': 'working', 'pid': os.getpid(), 'stage': 'starting',
+                       'last_upload': record.get('last_upload', -1), 'started': now,
+                       'heartbeat': now, 'finished': record.get('finished', 0), 'message': ''}
+        self.update()
+        self.stopping.clear()
+        self.beating = threading.Thread(target=self.beat, name='heartbeat', daemon=True)
+        self.beating.start()
+        return int(self.record['last_upload'])
+
+    def lock(self) -> None:
+        """Take the flock, raising RuntimeError if another run has it."""
+        fd = os.open(lock_file(self.dir), os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            record = read_heartbeat(self.dir)
+            raise RuntimeError('Working: pid {0} ({1}) last was {2}'.format(
+                record.get('pid'), record.get('stage'), record.get('last_upload', -1)))
+        self.fd = fd
+
+    def update(self, **fields: Any) -> None:
+        """Change FIELDS (stage, last_upload, ...) of the record and write it."""
+        with self.writing:
+            self.record.update(fields, heartbeat=int(time.time()))
+            path = heartbeat_file(self.dir)
+            tmpfile = path.with_name(path.name + '.tmp')
+            tmpfile.write_text(json.dumps(self.record) + '\n')
+            os.replace(tmpfile, path)
+
+    def beat(self) -> None:
+        while not self.stopping.wait(self.interval):
+            self.update()
+
+    def release(self, error: Optional[str] = None) -> None:
+        """Record how the run ended (ERROR is the message it failed with,
+        if it failed) and give up the lock."""
+        self.stopping.set()
+        if self.beating is not None:
+            self.beating.join()
+            self.beating = None
+        state = 'idle'
+        if error is not None:
+            state = 'failed'
+            if error.startswith(illegal_state_prefix()):
+                state = 'illegal_state'
+            elif error.startswith(timeout_prefix()):
+                state = 'timed_out'
+            elif error.startswith(interrupted_prefix()):
+                state = 'interrupted'
+        self.update(state=state, stage='', finished=int(time.time()), message=error or '')
+        self.unlock()
+
+    def unlock(self) -> None:
+        if self.fd is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
+
+def clear(dir: Path) -> None:
+    """Mark the last run in DIR as finished, keeping its last upload, so
+    the next run goes ahead."""
+    lock = UploadLock(dir)
+    lock.lock()
+    lock.record = read_heartbeat(dir)
+    lock.update(state='idle', stage='', message='')
+    lock.unlock()
+
+def main(argv: list[str]) -> int:
+    from csv_update import get_data_dirs
+    dir: Path = get_data_dirs()['outputdir']
+    print(describe(read_heartbeat(dir)), '(locked)' if lock_held(dir) else '(not locked)')
+    if '--clear' in argv[1:]:
+        clear(dir)
+        print('Cleared')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))